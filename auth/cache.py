@@ -0,0 +1,65 @@
+import os
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Hashable, Optional
+from metrics import Counter
+from dotenv import load_dotenv
+load_dotenv()
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "60"))
+
+cache_hits = Counter("cache_hits_total", "Cache lookups served from memory")
+cache_misses = Counter("cache_misses_total", "Cache lookups that fell through")
+
+
+class TTLCache:
+    """Bounded LRU map whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= monotonic():
+            if entry is not None:
+                del self._data[key]
+            cache_misses.inc(cache=self.name)
+            return None
+        self._data.move_to_end(key)
+        cache_hits.inc(cache=self.name)
+        return entry[0]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        self._data[key] = (value, monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# Validated UserOut by user id. Per process: other workers see a change after at most USER_CACHE_TTL
+user_cache = TTLCache("user", USER_CACHE_SIZE, USER_CACHE_TTL)
+# (email, id) claims of tokens whose signature was already verified, never kept past the token's exp
+token_cache = TTLCache("token", TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+
+def invalidate_user(user_id: int):
+    """Call whenever a users row changes so the next request reloads it"""
+    user_cache.delete(user_id)
@@ -0,0 +1,80 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from fastapi import HTTPException
+from starlette import status
+from passlib.context import CryptContext
+from metrics import Counter, Gauge, Histogram
+from dotenv import load_dotenv
+load_dotenv()
+
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+HASH_QUEUE_DEPTH = int(os.getenv("PASSWORD_HASH_QUEUE_DEPTH", "32"))
+
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.5, 5.0)
+
+hash_queue_wait = Histogram("password_hash_queue_wait_seconds", "Time a hash or verify waited for a worker", HASH_BUCKETS)
+hash_duration = Histogram("password_hash_duration_seconds", "Time spent inside bcrypt per operation", HASH_BUCKETS)
+hash_rejected = Counter("password_hash_rejected_total", "Hash or verify calls rejected because the queue was full")
+hash_pending = Gauge("password_hash_pending", "Hash or verify calls running or queued")
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a small dedicated thread pool (bcrypt releases the GIL while hashing),
+    so a login burst only slows down logins instead of every coroutine on the event loop.
+    """
+
+    def __init__(self, context: CryptContext, workers: int = HASH_WORKERS, queue_depth: int = HASH_QUEUE_DEPTH):
+        self.context = context
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._pending = 0
+        hash_pending.set_function(lambda: self._pending)
+
+    async def _run(self, operation: str, fn, *args):
+        if self._pending >= self.workers + self.queue_depth:
+            hash_rejected.inc(operation=operation)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many login attempts in progress, try again shortly",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        queued_at = perf_counter()
+
+        def job():
+            started_at = perf_counter()
+            result = fn(*args)
+            return result, started_at - queued_at, perf_counter() - started_at
+
+        # The slot is freed when bcrypt is done, not when the caller is: a cancelled request
+        # leaves its job running on the pool, which still counts against the queue
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(job)
+        future.add_done_callback(lambda _: self._release(loop))
+        result, waited, took = await asyncio.wrap_future(future)
+        hash_queue_wait.observe(waited, operation=operation)
+        hash_duration.observe(took, operation=operation)
+        return result
+
+    def _release(self, loop):
+        # Runs on the worker thread, or on the loop when a queued job is cancelled
+        try:
+            loop.call_soon_threadsafe(self._decrement)
+        except RuntimeError:
+            pass  # Loop already closed at shutdown
+
+    def _decrement(self):
+        self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run("hash", self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run("verify", self.context.verify, password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
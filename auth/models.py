@@ -1,22 +1,39 @@
-from sqlalchemy import Column, String, Boolean, Integer, Float, ForeignKey, DateTime, Enum
+from sqlalchemy import Column, String, Boolean, Integer, Float, ForeignKey, DateTime, Enum, Index
 from sqlalchemy.orm import relationship
-from datetime import datetime, timezone
-from database import Base
+from database import Base, utcnow
 from .enums import Gender
 
 
+def _lower(column):
+    return lambda context: (context.get_current_parameters().get(column) or "").lower()
+
+
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # Directory order and prefix search run on the normalized copies
+        Index("ix_users_username_lower", "username_lower", "id"),
+        Index("ix_users_email_lower", "email_lower", "id"),
+        # Postgres orders text by the database locale, prefix LIKE needs pattern_ops to use an index
+        Index("ix_users_username_lower_pattern", "username_lower",
+              postgresql_ops={"username_lower": "text_pattern_ops"}).ddl_if(dialect="postgresql"),
+        Index("ix_users_email_lower_pattern", "email_lower",
+              postgresql_ops={"email_lower": "text_pattern_ops"}).ddl_if(dialect="postgresql"),
+        # max(updated_at) is the directory's ETag
+        Index("ix_users_updated_at", "updated_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     email = Column(String, index=True, nullable=False)
     username = Column(String, nullable=False)
+    username_lower = Column(String, nullable=False, default=_lower("username"))
+    email_lower = Column(String, nullable=False, default=_lower("email"))
     hashed_password = Column(String, nullable=False)
     profile_picture = Column(String, nullable=True)
     profile_public_id = Column(String, nullable=True)
     gender = Column(Enum(Gender), nullable=False)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
     
     sent_messages = relationship("Message", foreign_keys="Message.sender_id", back_populates="sender")
     received_messages = relationship("Message", foreign_keys="Message.receiver_id", back_populates="receiver")
\ No newline at end of file
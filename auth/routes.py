@@ -1,32 +1,39 @@
-from fastapi import APIRouter, Depends, File, HTTPException, Request, Response, UploadFile
+from fastapi import APIRouter, Depends, File, HTTPException, Query, Request, Response, UploadFile
 from starlette import status
 from .models import User
-from .schemas import UserCreate, UserOut, UserLogin
-from typing import Annotated, List
-from sqlalchemy.orm import Session
-from database import get_db
-from .service import authenticate_user, check_user_exists, check_all_fields, create_user as create_user_srv, generate_token, get_current_user
-from cloudinary_srv import delete_file, upload_file
+from .schemas import UserCreate, UserOut, UserLogin, UserPage
+from typing import Annotated, Optional
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, get_read_db
+from .service import authenticate_user, check_user_exists, check_all_fields, create_user as create_user_srv, generate_token, get_current_user, get_directory_version, list_users, set_profile_picture, MAX_USER_PAGE_SIZE, USER_PAGE_SIZE
+from functools import partial
+from media_pipeline import upload_pipeline
+from etag import etag_matches, make_etag, not_modified, query_key, set_etag
+from rate_limit import enforce
+from logs import get_logger
+
+log = get_logger("auth")
 
 router = APIRouter(
     prefix="/auth",
     tags=["Auth"]
 )
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
 user_dependency = Annotated[User, Depends(get_current_user)]
 
 @router.post("/register", status_code=status.HTTP_201_CREATED, response_model=UserOut)
 async def create_user(db : db_dependency, user_model : UserCreate, response : Response):
     try:
-        check_user_exists(db, user_model.email)
+        await check_user_exists(db, user_model.email)
         check_all_fields(user_model)
-        user = create_user_srv(db, user_model, response)
+        user = await create_user_srv(db, user_model, response)
         return user
     except HTTPException as http_exp:
         raise http_exp
     except Exception as exp:
-        print(exp)
+        log.exception("request failed")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(exp)
@@ -35,13 +42,13 @@ async def create_user(db : db_dependency, user_model : UserCreate, response : Re
 @router.post("/login", status_code=status.HTTP_200_OK, response_model=UserOut)
 async def login_user(db: db_dependency, user_model : UserLogin, response : Response):
     try:
-        user = authenticate_user(db, user_model.email, user_model.password)
+        user = await authenticate_user(db, user_model.email, user_model.password)
         generate_token(user.email, user.id, response)
         return user
     except HTTPException as http_exp:
         raise http_exp
     except Exception as exp:
-        print(exp)
+        log.exception("request failed")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(exp)
@@ -68,31 +75,36 @@ async def logout_user(response : Response):
             detail=str(exp)
         )
         
-@router.put("/update-profile", status_code=status.HTTP_200_OK, response_model=UserOut)
-async def update_user(db : db_dependency, current_user : user_dependency, profilePic: UploadFile = File(...)):
+@router.put("/update-profile", status_code=status.HTTP_202_ACCEPTED, response_model=UserOut)
+async def update_user(current_user : user_dependency, request : Request, profilePic: UploadFile = File(...)):
     try:
-        user = db.query(User).filter(User.email == current_user.email).first()
-        if user.profile_picture is not None:
-            delete_file(user.profile_public_id)
-        result = upload_file(profilePic.file)
-        user.profile_picture = result["secure_url"]
-        user.profile_public_id = result["public_id"]
-        db.commit()
-        db.refresh(user)
-        return user
+        enforce("update_profile", request, current_user.id)
+        # Stored in the background, the client gets profilePictureUpdated once the new picture is live
+        spooled = await upload_pipeline.spool(profilePic, owner=current_user.id)
+        upload_pipeline.submit(spooled, "user_profiles", partial(set_profile_picture, current_user.id))
+        return current_user
+    except HTTPException as http_exp:
+        raise http_exp
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get("/users", status_code=status.HTTP_200_OK, response_model=List[UserOut])
-async def get_all_users(db : db_dependency, current_user : user_dependency):
+@router.get("/users", status_code=status.HTTP_200_OK, response_model=UserPage)
+async def get_all_users(db : read_db_dependency, current_user : user_dependency, request : Request, response : Response,
+                        q : Optional[str] = Query(None, max_length=100), cursor : Optional[str] = Query(None),
+                        limit : int = Query(USER_PAGE_SIZE, ge=1, le=MAX_USER_PAGE_SIZE)):
     try:
-        users = db.query(User).filter(User.id != current_user.id).all()
-        return users
+        # The caller is part of the tag because they are left out of their own directory
+        etag = make_etag("users", current_user.id, *await get_directory_version(db),
+                         query_key(q=q.strip().lower() if q and q.strip() else None, cursor=cursor, limit=limit))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        set_etag(response, etag)
+        return await list_users(db, current_user.id, q=q, cursor=cursor, limit=limit)
     except HTTPException as htp_exp:
         raise htp_exp
     except Exception as exp:
-        HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(exp))
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(exp))
 
 
 @router.get("/check",status_code=status.HTTP_200_OK)
@@ -100,7 +112,7 @@ async def check_auth(user:user_dependency):
     try:
         return user
     except Exception as e:
-        print(e)
+        log.exception("request failed")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
 
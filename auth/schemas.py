@@ -1,6 +1,7 @@
 from pydantic import BaseModel, Field, EmailStr
 from .enums import Gender
 from datetime import datetime
+from typing import List, Optional
 
 
 class UserBase(BaseModel):
@@ -24,4 +25,9 @@ class UserOut(UserBase):
     updated_at : datetime
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+class UserPage(BaseModel):
+    users : List[UserOut]
+    next_cursor : Optional[str] = None
@@ -1,13 +1,21 @@
-from typing import Annotated
+from typing import Annotated, Optional
 from fastapi import Depends, HTTPException, Request, Response
 from starlette import status
 from .models import User
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, bindparam, func, or_, select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from .schemas import UserCreate, UserOut
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
-from database import get_db
+from database import SessionLocal, get_read_db, replica_engines
+from media_pipeline import upload_pipeline
+from chat_socket import emit_to_user
+from .hashing import PasswordHasher
+from .cache import invalidate_user, user_cache
+from .tokens import verify_token
+import base64
+import json
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -17,16 +25,31 @@ ALGORITHM = os.getenv("ALGORITHM")
 EXPIRES_AT = os.getenv("ACCESS_TOKEN_EXPIRE_TIME")
 
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-db_dependency = Annotated[Session, Depends(get_db)]
+password_hasher = PasswordHasher(bcrypt_context)
+# The user lookup of every request is served by a replica when there is one
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
 
+USER_PAGE_SIZE = 50
+MAX_USER_PAGE_SIZE = 200
+# Only what UserOut needs, the directory never loads password hashes or ORM objects
+USER_DIRECTORY_COLUMNS = (User.id, User.username, User.email, User.gender, User.is_active,
+                          User.profile_picture, User.created_at, User.updated_at)
 
-def check_user_exists(db: Session, email: str):
-    user = db.query(User).filter(User.email == email).first()
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
+
+async def get_user_by_id(db: AsyncSession, id: int):
+    return await db.get(User, id)
+
+async def check_user_exists(db: AsyncSession, email: str):
+    user = await get_user_by_email(db, email)
     if user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
 
-def check_user_exists_for_login(db: Session, email: str):
-    user = db.query(User).filter(User.email == email).first()
+async def check_user_exists_for_login(db: AsyncSession, email: str):
+    user = await get_user_by_email(db, email)
     if not user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found")
     return user
@@ -41,8 +64,8 @@ def check_all_fields(user_model : UserCreate):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Passwords must match")
     
     
-def create_password(password : str):
-    return bcrypt_context.hash(password)
+async def create_password(password : str):
+    return await password_hasher.hash(password)
 
 def generate_token(email : str, id : int, response : Response):
     encode = {
@@ -66,26 +89,132 @@ def generate_token(email : str, id : int, response : Response):
     )
 
 
-def create_user(db : Session, user_model : UserCreate, response : Response):
-    hashed_password = create_password(user_model.password)
+async def create_user(db : AsyncSession, user_model : UserCreate, response : Response):
+    hashed_password = await create_password(user_model.password)
     user = User(hashed_password=hashed_password, **user_model.model_dump(exclude={"password", "confirm_password"}))
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
+    invalidate_user(user.id)
     generate_token(user.email, user.id, response)
     return user
 
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = check_user_exists_for_login(db, email)
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await check_user_exists_for_login(db, email)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
-    if not bcrypt_context.verify(password, user.hashed_password):
+    if not await password_hasher.verify(password, user.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
     return user
 
 
-async def get_current_user(request : Request, db : db_dependency)-> UserOut:
+def _encode_user_cursor(username_lower: str, id: int) -> str:
+    raw = json.dumps([username_lower, id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_user_cursor(cursor: str):
+    try:
+        username_lower, id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(username_lower), int(id)
+    except (ValueError, TypeError, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+def _prefix(dialect: str, column, prefix: str):
+    if dialect == "postgresql":
+        # A range is only a prefix match under byte order, the database's locale collation may differ.
+        # LIKE compares characters and runs on the text_pattern_ops index
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return column.like(escaped + "%", escape="\\")
+    # SQLite compares bytes, the range walks the plain index where LIKE (case-insensitive) could not.
+    # The bound is the highest code point, a prefix followed by one above U+FFFF is still below it
+    return and_(column >= prefix, column < prefix + "\U0010ffff")
+
+
+async def get_directory_version(db: AsyncSession):
+    """(max id, max updated_at) changes whenever a user registers or changes, both read from an index"""
+    max_id, last_update = (await db.execute(select(func.max(User.id), func.max(User.updated_at)))).one()
+    return max_id or 0, int(last_update.timestamp() * 1000000) if last_update else 0
+
+
+async def list_users(db: AsyncSession, exclude_id: int, q: Optional[str] = None, cursor: Optional[str] = None, limit: int = USER_PAGE_SIZE):
+    """Directory page ordered by username, optionally filtered by a username or email prefix"""
+    limit = max(1, min(limit, MAX_USER_PAGE_SIZE))
+    query = select(User.username_lower, *USER_DIRECTORY_COLUMNS).where(User.id != exclude_id)
+    if q and q.strip():
+        prefix = q.strip().lower()
+        dialect = db.get_bind().dialect.name
+        query = query.where(or_(_prefix(dialect, User.username_lower, prefix), _prefix(dialect, User.email_lower, prefix)))
+    if cursor:
+        username_lower, id = _decode_user_cursor(cursor)
+        query = query.where(or_(
+            User.username_lower > username_lower,
+            and_(User.username_lower == username_lower, User.id > id)
+        ))
+    query = query.order_by(User.username_lower.asc(), User.id.asc()).limit(limit + 1)
+
+    rows = (await db.execute(query)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = _encode_user_cursor(rows[-1].username_lower, rows[-1].id) if has_more else None
+    return {"users": [row._mapping for row in rows], "next_cursor": next_cursor}
+
+
+async def backfill_normalized_names(batch_size: int = 1000):
+    """
+    Fills username_lower and email_lower of users from before the directory had them, lowered in
+    Python like every new row so prefixes match the same way. updated_at is kept, the directory ETag
+    does not change for it.
+    """
+    users = User.__table__
+    fill = update(users).where(users.c.id == bindparam("user_id")).values(
+        username_lower=bindparam("username_value"), email_lower=bindparam("email_value"), updated_at=users.c.updated_at
+    )
+    async with SessionLocal() as db:
+        while True:
+            rows = (await db.execute(
+                select(users.c.id, users.c.username, users.c.email)
+                .where(or_(users.c.username_lower.is_(None), users.c.email_lower.is_(None)))
+                .limit(batch_size)
+            )).all()
+            if not rows:
+                break
+            await db.execute(fill, [
+                {"user_id": id, "username_value": username.lower(), "email_value": email.lower()}
+                for id, username, email in rows
+            ])
+            await db.commit()
+        if db.get_bind().dialect.name == "postgresql":
+            # Added nullable by create_tables, required from here on
+            await db.execute(text("ALTER TABLE users ALTER COLUMN username_lower SET NOT NULL, "
+                                  "ALTER COLUMN email_lower SET NOT NULL"))
+            await db.commit()
+
+
+async def set_profile_picture(user_id: int, res: dict):
+    """Upload pipeline callback: swap in the new picture, then drop the reference on the old file"""
+    async with SessionLocal() as db:
+        user = await get_user_by_id(db, user_id)
+        if not user:
+            await upload_pipeline.media.release(res["public_id"])
+            return None
+        old_public_id = user.profile_public_id
+        user.profile_picture = res["secure_url"]
+        user.profile_public_id = res["public_id"]
+        await db.commit()
+        await db.refresh(user)
+        invalidate_user(user_id)
+        user_data = UserOut.model_validate(user).model_dump(mode="json")
+
+    if old_public_id:
+        await upload_pipeline.media.release(old_public_id)
+    await emit_to_user(user_id, "profilePictureUpdated", user_data)
+    return user
+
+
+async def get_current_user(request : Request, db : read_db_dependency)-> UserOut:
     token = request.cookies.get("access_token")
     if not token:
         raise HTTPException(
@@ -93,17 +222,24 @@ async def get_current_user(request : Request, db : db_dependency)-> UserOut:
             detail="Not authenticated - no token present in cookies"
         )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        id: int = payload.get("id")
-
-        if email is None or id is None:
+        claims = verify_token(token)
+        if claims is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Invalid authentication token"
             )
-        
-        user = db.query(User).filter(User.id == id).first()
+        email, id = claims
+
+        # A cached user skips the query
+        user = user_cache.get(id)
+        if user is not None:
+            return user
+
+        user = await get_user_by_id(db, id)
+        if not user and replica_engines:
+            # Just registered, the replica may not have the row yet
+            async with SessionLocal() as primary:
+                user = await get_user_by_id(primary, id)
 
         if not user:
             raise HTTPException(
@@ -111,7 +247,9 @@ async def get_current_user(request : Request, db : db_dependency)-> UserOut:
                 detail="User not found"
             )
 
-        return UserOut.model_validate(user)
+        user = UserOut.model_validate(user)
+        user_cache.set(id, user)
+        return user
     except JWTError as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
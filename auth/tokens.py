@@ -0,0 +1,30 @@
+import os
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from jose import jwt
+from .cache import token_cache
+from dotenv import load_dotenv
+load_dotenv()
+
+SECRET_KEY = os.getenv("SECRET_KEY")
+ALGORITHM = os.getenv("ALGORITHM")
+
+
+def verify_token(token: str) -> Optional[Tuple[str, int]]:
+    """
+    (email, id) claims of an access token, None if they are missing. Raises JWTError for a bad
+    signature or an expired token. Shared by get_current_user and the Socket.IO handshake.
+    """
+    # A cookie seen recently skips the signature check
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+    payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    email: str = payload.get("sub")
+    id: int = payload.get("id")
+    if email is None or id is None:
+        return None
+    claims = (email, id)
+    expires_at = payload.get("exp")
+    token_cache.set(token, claims, ttl=expires_at - datetime.now(timezone.utc).timestamp() if expires_at else None)
+    return claims
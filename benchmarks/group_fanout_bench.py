@@ -0,0 +1,148 @@
+"""
+Group send latency and fan-out: one group message row plus one room emit (conversation.groups)
+against writing a direct message per member and emitting to every member's user room.
+
+Every member has one socket registered with the real Socket.IO server, packets are counted at
+_send_eio_packet instead of going out on a network. Latency covers the write, the commit and the
+emit. Uses a throwaway SQLite file unless --database-url points somewhere else.
+
+    python benchmarks/group_fanout_bench.py --members 10 100 1000 --messages 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--messages", type=int, default=50, help="messages sent per group size and scheme")
+    parser.add_argument("--database-url", default=None)
+    return parser.parse_args()
+
+
+args = parse_args()
+if args.database_url:
+    os.environ["DATABASE_URL"] = args.database_url
+else:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+os.environ["MESSAGE_WRITE_MODE"] = "immediate"
+os.environ["GROUP_MAX_MEMBERS"] = str(max(args.members))
+
+from sqlalchemy import delete, insert, text
+from database import SessionLocal, create_tables, engine
+from auth.models import User
+from chat_socket import emit_to_user, group_room, registry, sio, user_room
+from conversation.models import ChatGroup, ConversationSummary, GroupMember, Message
+from conversation.groups import create_group_message
+from conversation.search import create_search_index
+from conversation.service import after_messages_inserted, message_payload
+
+
+class Counters:
+    def __init__(self):
+        self.emits = 0
+        self.deliveries = 0
+
+
+counters = Counters()
+
+
+def instrument():
+    emit = sio.emit
+
+    async def counting_emit(*args, **kwargs):
+        counters.emits += 1
+        return await emit(*args, **kwargs)
+
+    async def counting_send(eio_sid, eio_pkt):
+        counters.deliveries += 1
+
+    sio.emit = counting_emit
+    sio._send_eio_packet = counting_send
+
+
+async def reset(members):
+    async with SessionLocal() as db:
+        for model in (GroupMember, ChatGroup, ConversationSummary, Message, User):
+            await db.execute(delete(model))
+        if engine.dialect.name == "sqlite":
+            await db.execute(text("INSERT INTO message_fts(message_fts) VALUES ('delete-all')"))
+        await db.execute(insert(User), [
+            {"id": id, "email": f"bench{id}@example.com", "username": f"bench{id}",
+             "hashed_password": "x", "gender": "male"}
+            for id in range(1, members + 1)
+        ])
+        await db.execute(insert(ChatGroup), [{"id": 1, "name": "bench", "created_by": 1}])
+        await db.execute(insert(GroupMember), [{"group_id": 1, "user_id": id, "last_read_message_id": 0}
+                                               for id in range(1, members + 1)])
+        await db.commit()
+
+
+async def connect_sockets(members):
+    """One socket per member, in its user room and in the group room"""
+    for sid in list(registry.socket_user_map):
+        await sio.manager.disconnect(sid, "/")
+        registry._remove(sid)
+    for id in range(1, members + 1):
+        eio_sid = f"eio-{id}"
+        sid = await sio.manager.connect(eio_sid, "/")
+        await sio.manager.enter_room(sid, "/", user_room(id), eio_sid=eio_sid)
+        await sio.manager.enter_room(sid, "/", group_room(1), eio_sid=eio_sid)
+        registry._add(str(id), sid)
+
+
+async def send_to_group(members, index):
+    async with SessionLocal() as db:
+        await create_group_message(db, 1, 1, f"message {index}")
+    return 1
+
+
+async def send_per_member(members, index):
+    """A group without group storage: a direct message row and an emit for every other member"""
+    async with SessionLocal() as db:
+        messages = [Message(sender_id=1, receiver_id=id, content=f"message {index}") for id in range(2, members + 1)]
+        db.add_all(messages)
+        await db.flush()
+        await after_messages_inserted(db, messages)
+        await db.commit()
+    for message in messages:
+        await emit_to_user(message.receiver_id, "newMessage", message_payload(message))
+    return len(messages)
+
+
+async def run(members, send):
+    counters.emits = counters.deliveries = 0
+    latencies, rows = [], 0
+    for index in range(args.messages):
+        started = time.perf_counter()
+        rows += await send(members, index)
+        latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    per_send = lambda total: total / args.messages
+    return statistics.median(latencies), p99, per_send(rows), per_send(counters.emits), per_send(counters.deliveries)
+
+
+async def main():
+    await create_tables()
+    await create_search_index()
+    instrument()
+    print(f"{'members':>8} {'scheme':<12} {'p50 ms':>8} {'p99 ms':>8} {'rows/send':>10} {'emits/send':>11} {'packets/send':>13}")
+    for members in args.members:
+        for name, send in (("group room", send_to_group), ("per member", send_per_member)):
+            await reset(members)
+            await connect_sockets(members)
+            p50, p99, rows, emits, deliveries = await run(members, send)
+            print(f"{members:>8} {name:<12} {p50:>8.2f} {p99:>8.2f} {rows:>10.0f} {emits:>11.0f} {deliveries:>13.0f}")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
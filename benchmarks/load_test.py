@@ -0,0 +1,394 @@
+"""
+Offline load test: the real app served by uvicorn on a loopback port inside this process, a
+throwaway SQLite database seeded with --users users and --messages direct messages, and media
+storage replaced by an in-memory stub, so nothing leaves the machine.
+
+Every scenario runs --clients concurrent simulated clients issuing --requests requests each and
+reports throughput, p50/p99 latency and SQL statements per request (from the
+http_request_db_queries histogram of instrumentation.py). The socket scenario connects one
+Socket.IO client per simulated user, sends with sendMessage and times the ack and the newMessage
+delivery on the receiving socket.
+
+Before the scenarios the query guard runs each guarded endpoint once at a small and once at a
+large page size. The statement count must not grow with the page and must stay within the
+endpoint's budget, otherwise an N+1 slipped in: the run reports it and exits with status 1.
+
+    python benchmarks/load_test.py --users 200 --messages 20000 --clients 50 --requests 20
+    python benchmarks/load_test.py --guard-only
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = ("login", "register", "history", "inbox", "send", "upload", "socket")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--peers", type=int, default=10, help="conversations per seeded user")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent simulated clients")
+    parser.add_argument("--requests", type=int, default=20, help="requests per client and scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--upload-latency-ms", type=float, default=50, help="simulated storage round trip")
+    parser.add_argument("--guard-only", action="store_true", help="run the query guard and skip the scenarios")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep rate limits and the per-user upload cap on, every client shares the loopback IP")
+    return parser.parse_args()
+
+
+args = parse_args()
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/load.db"
+os.environ["MESSAGE_WRITE_MODE"] = "immediate"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+if not args.rate_limits:
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    os.environ["UPLOAD_MAX_PER_USER"] = str(args.requests + 1)
+
+import httpx
+import socketio
+import uvicorn
+from PIL import Image
+from sqlalchemy import insert
+from starlette.responses import Response
+import main
+from auth.models import User
+from auth.service import bcrypt_context, generate_token
+from cloudinary_srv import MediaStorage
+from conversation.models import Message
+from database import SessionLocal, create_tables
+from instrumentation import request_queries
+from media_pipeline import upload_pipeline
+
+PASSWORD = "load-test-password"
+
+# name, route template, statement budget, path with the page size left to fill in, small and large page size
+QUERY_GUARDS = (
+    ("history", "/messages/{receiver_id}/", 3, "/messages/2/?limit={}", 5, 100),
+    ("inbox", "/conversations", 3, "/conversations?limit={}", 2, 50),
+    ("users", "/auth/users", 3, "/auth/users?limit={}", 2, 50),
+    ("search", "/messages/search", 3, "/messages/search?q=word7&limit={}", 2, 50),
+)
+
+
+class StubStorage(MediaStorage):
+    """Keeps nothing, answers after a fixed delay with Cloudinary-shaped results"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def upload(self, file, folder: str):
+        time.sleep(self.latency)
+        public_id = f"{folder}/{uuid.uuid4().hex}"
+        return {"secure_url": self.url(public_id), "public_id": public_id, "resource_type": "image"}
+
+    def delete(self, public_id: str):
+        return {"result": "ok"}
+
+    def url(self, public_id: str):
+        return f"https://media.invalid/{public_id}"
+
+
+def peers_of(user_id: int):
+    """The seeded conversation partners of a user, its neighbours on a ring"""
+    return [(user_id + offset - 1) % args.users + 1 for offset in range(1, args.peers // 2 + 1)] + \
+           [(user_id - offset - 1) % args.users + 1 for offset in range(1, args.peers // 2 + 1)]
+
+
+async def seed():
+    hashed = bcrypt_context.hash(PASSWORD)
+    rng = random.Random(7)
+    guard_messages = 2 * max(large for *_, large in QUERY_GUARDS)
+    # Recent, so everything is in the hot tier (conversation.archive)
+    started = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=args.messages + guard_messages)
+    async with SessionLocal() as db:
+        await db.execute(insert(User), [
+            {"id": id, "email": f"load{id}@example.com", "username": f"load{id}", "hashed_password": hashed,
+             "gender": "male"}
+            for id in range(1, args.users + 1)
+        ])
+        for chunk_start in range(0, args.messages, 5000):
+            rows = []
+            for n in range(chunk_start, min(chunk_start + 5000, args.messages)):
+                sender = rng.randint(1, args.users)
+                created_at = started + timedelta(seconds=n)
+                rows.append({"sender_id": sender, "receiver_id": rng.choice(peers_of(sender)),
+                             "content": f"load message {n} word{n % 50}", "delivered_at": created_at,
+                             "created_at": created_at, "updated_at": created_at})
+            await db.execute(insert(Message), rows)
+        # The guarded history of users 1 and 2 fills the large page too
+        await db.execute(insert(Message), [
+            {"sender_id": 1 + n % 2, "receiver_id": 2 - n % 2, "content": f"guard message {n}",
+             "delivered_at": started, "created_at": started + timedelta(seconds=args.messages + n),
+             "updated_at": started}
+            for n in range(guard_messages)
+        ])
+        await db.commit()
+
+
+def auth_cookie(user_id: int) -> dict:
+    response = Response()
+    generate_token(f"load{user_id}@example.com", user_id, response)
+    token = response.headers["set-cookie"].split(";", 1)[0].split("=", 1)[1]
+    return {"access_token": token}
+
+
+def png_bytes() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (200, 80, 40)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class Result:
+    def __init__(self, name, latencies, errors, elapsed, queries=None):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.queries = queries
+
+    def row(self):
+        count = len(self.latencies)
+        p50 = statistics.median(self.latencies) * 1000 if count else 0
+        p99 = percentile(self.latencies, 0.99) * 1000 if count else 0
+        queries = f"{self.queries:.1f}" if self.queries is not None else "-"
+        return (f"{self.name:<16} {count:>8} {self.errors:>7} {count / self.elapsed:>9.1f} "
+                f"{p50:>9.2f} {p99:>9.2f} {queries:>9}")
+
+
+class QueryDelta:
+    """Statements per request of a route over a block of requests"""
+
+    def __init__(self, route):
+        self.route = route
+        self.total = request_queries.total(route=route)
+        self.count = request_queries.count(route=route)
+
+    def per_request(self):
+        count = request_queries.count(route=self.route) - self.count
+        return (request_queries.total(route=self.route) - self.total) / count if count else None
+
+
+async def run_clients(name, route, operation):
+    """operation(client, index) is awaited args.requests times by each of args.clients clients"""
+    latencies, errors = [], 0
+    queries = QueryDelta(route) if route else None
+
+    async def client(number):
+        nonlocal errors
+        for index in range(args.requests):
+            started = time.perf_counter()
+            try:
+                ok = await operation(number, index)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(number) for number in range(args.clients)))
+    return Result(name, latencies, errors, time.perf_counter() - started, queries.per_request() if queries else None)
+
+
+def user_of(client: int) -> int:
+    return client % args.users + 1
+
+
+async def query_guard(base_url) -> list:
+    failures = []
+    async with httpx.AsyncClient(base_url=base_url, cookies=auth_cookie(1)) as http:
+        # Warm the user cache, it would otherwise add a statement to the first request only
+        await http.get("/auth/check")
+        print(f"{'guard':<10} {'small':>6} {'large':>6} {'budget':>7}")
+        for name, route, budget, path, small, large in QUERY_GUARDS:
+            counts = []
+            for size in (small, large):
+                delta = QueryDelta(route)
+                response = await http.get(path.format(size))
+                if response.status_code != 200 or delta.per_request() is None:
+                    failures.append(f"{name}: {path.format(size)} answered {response.status_code} under no {route} metric")
+                counts.append(delta.per_request() or 0)
+            print(f"{name:<10} {counts[0]:>6.0f} {counts[1]:>6.0f} {budget:>7}")
+            if counts[1] > counts[0]:
+                failures.append(f"{name}: {counts[0]:.0f} statements at limit={small} but {counts[1]:.0f} at "
+                                f"limit={large}, the query count grows with the page (N+1)")
+            if max(counts) > budget:
+                failures.append(f"{name}: {max(counts):.0f} statements per request, the budget is {budget}")
+    return failures
+
+
+async def http_scenarios(base_url):
+    image = png_bytes()
+    limits = httpx.Limits(max_connections=args.clients, max_keepalive_connections=args.clients)
+    clients = [httpx.AsyncClient(base_url=base_url, cookies=auth_cookie(user_of(number)), limits=limits)
+               for number in range(args.clients)]
+    run_id = uuid.uuid4().hex[:8]
+
+    async def login(number, index):
+        response = await clients[number].post("/auth/login", json={"email": f"load{user_of(number)}@example.com",
+                                                                   "password": PASSWORD})
+        return response.status_code == 200
+
+    async def register(number, index):
+        username = f"new{run_id}{number}x{index}"
+        response = await clients[number].post("/auth/register", json={
+            "username": username, "email": f"{username}@example.com", "gender": "male",
+            "password": PASSWORD, "confirm_password": PASSWORD
+        })
+        return response.status_code == 201
+
+    async def history(number, index):
+        peer = peers_of(user_of(number))[index % args.peers]
+        return (await clients[number].get(f"/messages/{peer}/")).status_code == 200
+
+    async def inbox(number, index):
+        return (await clients[number].get("/conversations")).status_code == 200
+
+    async def send(number, index):
+        peer = peers_of(user_of(number))[index % args.peers]
+        response = await clients[number].post(f"/messages/send/{peer}", data={"content": f"load send {index}"})
+        return response.status_code == 201
+
+    async def upload(number, index):
+        peer = peers_of(user_of(number))[index % args.peers]
+        # Distinct bytes per upload, identical ones would be deduplicated instead of stored
+        response = await clients[number].post(f"/messages/send/{peer}", files={
+            "img_file": ("load.png", image + uuid.uuid4().bytes, "image/png")
+        })
+        return response.status_code == 201
+
+    scenarios = {
+        "login": ("/auth/login", login),
+        "register": ("/auth/register", register),
+        "history": ("/messages/{receiver_id}/", history),
+        "inbox": ("/conversations", inbox),
+        "send": ("/messages/send/{receiver_id}", send),
+        "upload": ("/messages/send/{receiver_id}", upload),
+    }
+    results = []
+    try:
+        for name in args.scenarios:
+            if name in scenarios:
+                route, operation = scenarios[name]
+                results.append(await run_clients(name, route, operation))
+    finally:
+        for client in clients:
+            await client.aclose()
+    return results
+
+
+async def socket_scenario(base_url):
+    """Connect, sendMessage ack and newMessage delivery, one socket per user"""
+    users = min(args.clients, args.users)
+    sent_at, delivered = {}, []
+    sockets = {}
+
+    def on_new_message(data):
+        started = sent_at.pop(data.get("content"), None)
+        if started is not None:
+            delivered.append(time.perf_counter() - started)
+
+    connect_latencies, connect_errors = [], 0
+    started = time.perf_counter()
+
+    async def connect(user_id):
+        nonlocal connect_errors
+        client = socketio.AsyncClient(reconnection=False)
+        client.on("newMessage", on_new_message)
+        begun = time.perf_counter()
+        try:
+            cookie = auth_cookie(user_id)["access_token"]
+            await client.connect(base_url, headers={"Cookie": f"access_token={cookie}"}, transports=["websocket"])
+            connect_latencies.append(time.perf_counter() - begun)
+            sockets[user_id] = client
+        except Exception:
+            connect_errors += 1
+
+    await asyncio.gather(*(connect(user_id) for user_id in range(1, users + 1)))
+    results = [Result("socket connect", connect_latencies, connect_errors, time.perf_counter() - started)]
+
+    async def send(number, index):
+        user_id = number % users + 1
+        client = sockets.get(user_id)
+        if client is None:
+            return False
+        # Only peers that are connected too, so every message has a socket to arrive at
+        peer = next((peer for peer in peers_of(user_id)[index % args.peers:] + peers_of(user_id) if peer in sockets), None)
+        if peer is None:
+            return False
+        content = f"load socket {number}-{index}"
+        sent_at[content] = time.perf_counter()
+        ack = await client.call("sendMessage", {"receiver_id": peer, "content": content}, timeout=10)
+        return bool(ack and ack.get("ok"))
+
+    results.append(await run_clients("socket send", None, send))
+    # Deliveries still in flight when the last ack came back
+    deadline = time.perf_counter() + 5
+    while sent_at and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    results.append(Result("socket deliver", delivered, len(sent_at), results[-1].elapsed))
+    await asyncio.gather(*(client.disconnect() for client in sockets.values()))
+    return results
+
+
+async def main_async():
+    await create_tables()
+    seeding = time.perf_counter()
+    await seed()
+    upload_pipeline.storage = upload_pipeline.media.storage = StubStorage(args.upload_latency_ms / 1000)
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        if serving.done():
+            serving.result()
+        await asyncio.sleep(0.05)
+    print(f"seeded {args.users} users and {args.messages} messages in {time.perf_counter() - seeding:.1f}s")
+    base_url = f"http://127.0.0.1:{port}"
+
+    try:
+        failures = await query_guard(base_url)
+        if not args.guard_only:
+            results = await http_scenarios(base_url)
+            if "socket" in args.scenarios:
+                results += await socket_scenario(base_url)
+            print(f"\n{args.clients} clients x {args.requests} requests")
+            print(f"{'scenario':<16} {'requests':>8} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'queries':>9}")
+            for result in results:
+                print(result.row())
+    finally:
+        server.should_exit = True
+        await serving
+
+    if failures:
+        print("\nQUERY GUARD FAILED", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main_async())
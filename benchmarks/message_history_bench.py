@@ -0,0 +1,150 @@
+"""
+Message history serialization: ORM objects validated through MessagePage (the previous path)
+against MESSAGE_COLUMNS rows dumped with orjson (conversation.service.dump_message_page).
+
+For every conversation size the whole history is read twice: walking back page by page as a
+client scrolling up would, and as a single unpaged response. Time is the best of --repeat runs,
+peak memory is measured in a separate run under tracemalloc.
+
+    python benchmarks/message_history_bench.py --sizes 1000 10000 100000 --limit 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from sqlalchemy import and_, delete, insert, or_, select
+from database import SessionLocal, create_tables, engine
+from auth.models import User
+from conversation.models import Message
+from conversation.schemas import MessagePage
+from conversation.service import MESSAGE_COLUMNS, decode_cursor, dump_message_page, encode_cursor, get_messages
+
+ALICE, BOB = 1, 2
+conversation = or_(
+    and_(Message.sender_id == ALICE, Message.receiver_id == BOB),
+    and_(Message.sender_id == BOB, Message.receiver_id == ALICE)
+)
+
+
+async def seed(size):
+    async with SessionLocal() as db:
+        await db.execute(delete(Message))
+        await db.execute(delete(User))
+        await db.execute(insert(User), [
+            {"id": id, "email": f"bench{id}@example.com", "username": f"bench{id}", "hashed_password": "x", "gender": "male"}
+            for id in (ALICE, BOB)
+        ])
+        start = datetime(2025, 1, 1)
+        for offset in range(0, size, 10000):
+            await db.execute(insert(Message), [
+                {"sender_id": (ALICE, BOB)[index % 2], "receiver_id": (BOB, ALICE)[index % 2],
+                 "content": f"Message number {index}, see you at the station at 6",
+                 "created_at": start + timedelta(seconds=index), "updated_at": start + timedelta(seconds=index)}
+                for index in range(offset, min(offset + 10000, size))
+            ])
+        await db.commit()
+
+
+def orm_json(messages, before_cursor=None, after_cursor=None):
+    # What response_model did: validate every ORM object, then dump the model to JSON
+    page = MessagePage.model_validate({"messages": messages, "before_cursor": before_cursor, "after_cursor": after_cursor},
+                                      from_attributes=True)
+    return json.dumps(page.model_dump(mode="json"), separators=(",", ":")).encode()
+
+
+async def orm_paged(limit):
+    total, before = 0, None
+    async with SessionLocal() as db:
+        while True:
+            query = select(Message).where(conversation)
+            if before:
+                created_at, message_id = decode_cursor(before)
+                query = query.where(or_(Message.created_at < created_at,
+                                        and_(Message.created_at == created_at, Message.id < message_id)))
+            result = await db.execute(query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1))
+            messages = list(result.scalars().all())
+            has_more = len(messages) > limit
+            messages = messages[:limit][::-1]
+            after = encode_cursor(messages[-1]) if messages and before else None
+            before = encode_cursor(messages[0]) if messages and has_more else None
+            total += len(orm_json(messages, before, after))
+            if not before:
+                return total
+
+
+async def rows_paged(limit):
+    total, before = 0, None
+    async with SessionLocal() as db:
+        while True:
+            page = await get_messages(db, ALICE, BOB, before=before, limit=limit)
+            total += len(dump_message_page(page))
+            before = page["before_cursor"]
+            if not before:
+                return total
+
+
+async def orm_unpaged(limit):
+    async with SessionLocal() as db:
+        result = await db.execute(select(Message).where(conversation).order_by(Message.created_at, Message.id))
+        return len(orm_json(list(result.scalars().all())))
+
+
+async def rows_unpaged(limit):
+    async with SessionLocal() as db:
+        result = await db.execute(select(*MESSAGE_COLUMNS).where(conversation).order_by(Message.created_at, Message.id))
+        return len(dump_message_page({"messages": result.all(), "before_cursor": None, "after_cursor": None}))
+
+
+async def measure(fn, limit, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = await fn(limit)
+        best = min(best, time.perf_counter() - started)
+    tracemalloc.start()
+    await fn(limit)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, size
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--limit", type=int, default=200, help="page size while walking back")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    await create_tables()
+    # Both paths must produce the same document
+    await seed(10)
+    async with SessionLocal() as db:
+        page = await get_messages(db, ALICE, BOB, limit=5)
+        result = await db.execute(select(Message).where(conversation).order_by(Message.created_at, Message.id).offset(5))
+        expected = MessagePage.model_validate({"messages": result.scalars().all(), "before_cursor": page["before_cursor"]},
+                                              from_attributes=True)
+    assert json.loads(dump_message_page(page)) == expected.model_dump(mode="json")
+
+    print(f"{'messages':>8} {'mode':<8} {'orm ms':>9} {'rows ms':>9} {'speedup':>8} {'orm peak':>10} {'rows peak':>10} {'json':>10}")
+    for size in args.sizes:
+        await seed(size)
+        for mode, orm, rows in (("paged", orm_paged, rows_paged), ("unpaged", orm_unpaged, rows_unpaged)):
+            orm_time, orm_peak, orm_size = await measure(orm, args.limit, args.repeat)
+            rows_time, rows_peak, rows_size = await measure(rows, args.limit, args.repeat)
+            assert orm_size == rows_size
+            print(f"{size:>8} {mode:<8} {orm_time * 1000:>9.1f} {rows_time * 1000:>9.1f} {orm_time / rows_time:>7.1f}x"
+                  f" {orm_peak / 2**20:>8.1f}MB {rows_peak / 2**20:>8.1f}MB {rows_size / 2**20:>8.1f}MB")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
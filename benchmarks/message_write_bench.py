@@ -0,0 +1,103 @@
+"""
+Message write throughput: one commit per message against group commit (conversation.batcher).
+
+Concurrent senders each write --messages messages through conversation.service.persist_message
+(per-message path) or a MessageBatcher (grouped path), including the inbox upserts. Uses a
+throwaway SQLite file unless --database-url points somewhere else.
+
+    python benchmarks/message_write_bench.py --senders 1 10 50 --messages 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--senders", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--messages", type=int, default=200, help="messages per sender")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-delay-ms", type=float, default=5)
+    parser.add_argument("--database-url", default=None)
+    return parser.parse_args()
+
+
+args = parse_args()
+if args.database_url:
+    os.environ["DATABASE_URL"] = args.database_url
+else:
+    os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+os.environ["MESSAGE_WRITE_MODE"] = "immediate"
+
+from sqlalchemy import delete, insert, text
+from sqlalchemy.exc import OperationalError
+from database import SessionLocal, create_tables, engine
+from auth.models import User
+from conversation.models import ConversationSummary, Message
+from conversation.batcher import MessageBatcher
+from conversation.search import create_search_index
+from conversation.service import after_messages_inserted, persist_message
+
+
+async def reset(senders):
+    async with SessionLocal() as db:
+        await db.execute(delete(ConversationSummary))
+        await db.execute(delete(Message))
+        if engine.dialect.name == "sqlite":
+            await db.execute(text("INSERT INTO message_fts(message_fts) VALUES ('delete-all')"))
+        await db.execute(delete(User))
+        await db.execute(insert(User), [
+            {"id": id, "email": f"bench{id}@example.com", "username": f"bench{id}",
+             "hashed_password": "x", "gender": "male"}
+            for id in range(1, senders + 2)
+        ])
+        await db.commit()
+
+
+async def run(senders, messages, write):
+    """Returns (committed messages per second, writes that failed e.g. with SQLite's "database is locked")"""
+    failed = 0
+
+    async def sender(sender_id):
+        nonlocal failed
+        for index in range(messages):
+            try:
+                await write(Message(sender_id=sender_id, receiver_id=senders + 1, content=f"message {index}"))
+            except OperationalError:
+                failed += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(id) for id in range(1, senders + 1)))
+    return (senders * messages - failed) / (time.perf_counter() - started), failed
+
+
+async def main():
+    await create_tables()
+    await create_search_index()
+    print(f"backend: {engine.dialect.name}, {args.messages} messages per sender")
+    print(f"{'senders':>8} {'per-message msg/s':>18} {'failed':>7} {'grouped msg/s':>14} {'failed':>7} {'speedup':>8}")
+    for senders in args.senders:
+        await reset(senders)
+
+        async def immediate(message):
+            async with SessionLocal() as db:
+                await persist_message(db, message)
+        per_message, per_message_failed = await run(senders, args.messages, immediate)
+
+        await reset(senders)
+        batcher = MessageBatcher(SessionLocal, after_messages_inserted,
+                                 max_size=args.batch_size, max_delay=args.batch_delay_ms / 1000)
+        grouped, grouped_failed = await run(senders, args.messages, batcher.submit)
+        await batcher.close()
+        print(f"{senders:>8} {per_message:>18.0f} {per_message_failed:>7} {grouped:>14.0f} {grouped_failed:>7} "
+              f"{grouped / per_message:>7.1f}x")
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
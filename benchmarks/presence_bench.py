@@ -0,0 +1,120 @@
+"""
+Presence traffic during a reconnect storm: N single-socket users connect within --storm seconds.
+
+Compares the old scheme (full online list broadcast to every client on each connect) with
+one snapshot per socket plus batched userOnline deltas, globally and scoped to contacts.
+Nothing touches the network, emits are counted by a recording Socket.IO stand-in.
+
+    python benchmarks/presence_bench.py --sockets 1000 10000 --storm 2 --window 0.25
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from presence import PresenceBroadcaster
+from socket_backend import SocketRegistry
+
+
+def wire_size(data):
+    # python-socketio encodes packets with compact separators
+    return len(json.dumps(data, separators=(",", ":")))
+
+
+class RecordingServer:
+    def __init__(self, registry):
+        self.registry = registry
+        self.emit_calls = 0
+        self.deliveries = 0
+        self.bytes = 0
+
+    async def emit(self, event, data, room=None):
+        if room is None:
+            recipients = len(self.registry.socket_user_map)
+        elif room.startswith("user:"):
+            recipients = self.registry.socket_count(room[5:])
+        else:
+            recipients = 1
+        self.emit_calls += 1
+        self.deliveries += recipients
+        self.bytes += recipients * wire_size(data)
+
+
+def full_list_broadcast(sockets):
+    """Old behaviour: every connect sends the whole list to every connected socket"""
+    deliveries = total_bytes = 0
+    list_size = 2  # "[]"
+    for connected in range(1, sockets + 1):
+        list_size += len(str(connected)) + 2 + (1 if connected > 1 else 0)
+        deliveries += connected
+        total_bytes += connected * list_size
+    return sockets, deliveries, total_bytes
+
+
+def ring_contacts(sockets, per_user):
+    half = per_user // 2
+
+    async def loader(user_id):
+        uid = int(user_id)
+        return {str((uid + offset) % sockets) for offset in range(-half, half + 1) if offset}
+    return loader
+
+
+async def storm(sockets, duration, window, scope, contacts_per_user):
+    registry = SocketRegistry()
+    server = RecordingServer(registry)
+    presence = PresenceBroadcaster(server, registry, window=window, scope=scope,
+                                   contacts_loader=ring_contacts(sockets, contacts_per_user))
+    tick = 0.01
+    per_tick = max(1, int(sockets * tick / duration))
+    connected = 0
+    while connected < sockets:
+        for _ in range(min(per_tick, sockets - connected)):
+            user_id, sid = str(connected), f"sid-{connected}"
+            came_online = registry._add(user_id, sid)
+            await presence.snapshot(sid, user_id)
+            if came_online:
+                presence.user_online(user_id)
+            connected += 1
+        await asyncio.sleep(tick)
+    await asyncio.sleep(window * 2)
+    await presence.close()
+    return server.emit_calls, server.deliveries, server.bytes
+
+
+def human(count):
+    for unit in ("", "K", "M", "G", "T"):
+        if abs(count) < 1000:
+            return f"{count:.1f}{unit}"
+        count /= 1000
+    return f"{count:.1f}P"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sockets", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--storm", type=float, default=2.0, help="seconds over which all sockets connect")
+    parser.add_argument("--window", type=float, default=0.25, help="delta batching window in seconds")
+    parser.add_argument("--contacts", type=int, default=50, help="contacts per user for the scoped run")
+    args = parser.parse_args()
+
+    print(f"{'sockets':>8} {'scheme':<25} {'emit calls':>11} {'deliveries':>11} {'bytes':>10} {'cpu s':>7}")
+    for sockets in args.sockets:
+        started = time.process_time()
+        result = full_list_broadcast(sockets)
+        rows = [("full list broadcast", result, time.process_time() - started)]
+        for scope in ("all", "contacts"):
+            started = time.process_time()
+            result = asyncio.run(storm(sockets, args.storm, args.window, scope, args.contacts))
+            rows.append((f"snapshot+deltas/{scope}", result, time.process_time() - started))
+        for name, (calls, deliveries, size), cpu in rows:
+            print(f"{sockets:>8} {name:<25} {human(calls):>11} {human(deliveries):>11} {human(size) + 'B':>10} {cpu:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Socket.IO wire formats: encode cost and packet size of JSON text packets against the
+MessagePack packets of wire.py, for the events the server sends most.
+
+    python benchmarks/wire_format_bench.py --messages 10000 --online 1000 10000 --delta 50
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from socketio import packet
+from wire import WirePacket
+
+
+def message_data(index):
+    # Same shape as the newMessage payload built in conversation.service.create_message
+    created_at = datetime(2025, 1, 1) + timedelta(seconds=index)
+    return {
+        "id": 100000 + index,
+        "sender_id": 1000 + index % 500,
+        "receiver_id": 2000 + index % 700,
+        "content": "See you at the station at 6, I'll bring the tickets",
+        "image_url": None,
+        "image_id": None,
+        "media_status": None,
+        "created_at": created_at.isoformat()
+    }
+
+
+def measure(name, payloads, repeat):
+    packets = [WirePacket(packet.EVENT, data=[event, data], namespace="/") for event, data in payloads]
+    results = []
+    for label, encode in (("json", lambda pkt: packet.Packet.encode(pkt)), ("msgpack", WirePacket.encode_msgpack)):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            encoded = [encode(pkt) for pkt in packets]
+            best = min(best, time.perf_counter() - started)
+        size = sum(len(item.encode() if isinstance(item, str) else item) for item in encoded)
+        results.append((label, best, size))
+    (_, json_time, json_size), (_, msgpack_time, msgpack_size) = results
+    print(f"{name:<34} {len(packets):>7} {json_time * 1e6 / len(packets):>9.2f} {msgpack_time * 1e6 / len(packets):>9.2f}"
+          f" {json_size:>12,} {msgpack_size:>12,} {100 * (1 - msgpack_size / json_size):>6.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000, help="newMessage events")
+    parser.add_argument("--online", type=int, nargs="+", default=[1000, 10000], help="getOnlineUsers snapshot sizes")
+    parser.add_argument("--delta", type=int, default=50, help="user ids per userOnline delta")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'event':<34} {'packets':>7} {'json us':>9} {'mpack us':>9} {'json bytes':>12} {'mpack bytes':>12} {'saved':>7}")
+    measure("newMessage", [("newMessage", message_data(index)) for index in range(args.messages)], args.repeat)
+    for online in args.online:
+        snapshot = [str(id) for id in range(1, online + 1)]
+        measure(f"getOnlineUsers ({online} ids)", [("getOnlineUsers", snapshot)] * 100, args.repeat)
+    deltas = [("userOnline", [str(10000 + index * args.delta + id) for id in range(args.delta)]) for index in range(1000)]
+    measure(f"userOnline ({args.delta} ids)", deltas, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,67 +1,144 @@
-import socketio
+from http.cookies import SimpleCookie
+from typing import Optional
+from jose import JWTError
+from socketio.exceptions import ConnectionRefusedError
+from rate_limit import environ_ip, limits, retry_after
+from auth.tokens import verify_token
+from socket_backend import create_client_manager, create_registry
+from presence import PresenceBroadcaster
+from wire import NegotiatingServer
+from logs import get_logger
+from metrics import Counter, Gauge
 
 # --- Socket.IO setup ---
-sio = socketio.AsyncServer(
+# The client manager fans emits out to every server process, the registry tracks who is online where.
+# Each client picks JSON or MessagePack packets at connect, see wire.py
+client_manager = create_client_manager()
+sio = NegotiatingServer(
     async_mode="asgi",
     cors_allowed_origins=["https://chat-app-frontend-ecfx.onrender.com"],
-    allow_upgrades=True
+    allow_upgrades=True,
+    client_manager=client_manager
 )
+registry = create_registry(client_manager)
 
+log = get_logger("chat_socket")
+user_deliveries = Counter("socketio_user_deliveries_total", "emit_to_user calls by whether the user had a live socket")
+connected_sockets = Gauge("socketio_connected_sockets", "Sockets connected to this process", lambda: len(sio.eio.sockets))
+online_users = Gauge("socketio_online_users", "Users with at least one live socket", lambda: len(registry.user_sockets))
 
-user_socket_map = {}
-socket_user_map = {}
 
-def get_receiver_socket_id(user_id):
-    """Get socket ID for a user - convert to string for consistency"""
-    return user_socket_map.get(str(user_id))
+async def start_socket_backend():
+    """Join the pub/sub channel at startup rather than on the first socket connection"""
+    if not sio.manager_initialized:
+        sio.manager_initialized = True
+        sio.manager.initialize()
+    if hasattr(client_manager, "start"):
+        await client_manager.start()
+
+async def stop_socket_backend():
+    await presence.close()
+    await registry.close()
+    if hasattr(client_manager, "close"):
+        await client_manager.close()
+
+def user_room(user_id):
+    """Every socket of a user joins this room, so one emit reaches all their devices"""
+    return f"user:{user_id}"
+
+def group_room(group_id):
+    """Every socket of every member joins this room, a group message is one emit whatever the group size"""
+    return f"group:{group_id}"
+
+presence = PresenceBroadcaster(sio, registry, room_for=user_room)
+# Users of another process that died are announced from here
+registry.on_offline = presence.user_offline
+
+async def emit_to_user(user_id, event, data):
+    """Emit an event to a specific user, returns False if the user is not connected"""
+    if not registry.is_online(user_id):
+        user_deliveries.inc(result="offline")
+        log.debug("user not connected", event=event, user_id=user_id)
+        return False
+
+    await sio.emit(event, data, room=user_room(user_id))
+    user_deliveries.inc(result="delivered")
+    log.debug("emitted to user", event=event, user_id=user_id, sockets=registry.socket_count(user_id))
+    return True
 
 async def send_new_message(receiver_id, message_data):
     """Send new message to a specific user"""
-    print("Sending new message:", message_data)
-    receiver_socket_id = get_receiver_socket_id(receiver_id)
-    print("Receiver socket ID:", receiver_socket_id)
-    
-    if receiver_socket_id:
-        await sio.emit("newMessage", message_data, room=receiver_socket_id)
-        print(f"Message sent to user {receiver_id} on socket {receiver_socket_id}")
-        return True
-    else:
-        print(f"User {receiver_id} is not connected")
-        return False
+    # The first message of a conversation makes the two contacts for presence
+    await presence.add_contact(message_data["sender_id"], receiver_id)
+    return await emit_to_user(receiver_id, "newMessage", message_data)
+
+async def send_group_message(group_id, message_data):
+    await sio.emit("newGroupMessage", message_data, room=group_room(group_id))
+
+async def join_room_for_user(user_id, room):
+    """Adds every live socket of a user to a room, on whichever process holds them"""
+    for sid in list(registry.user_sockets.get(str(user_id), ())):
+        await sio.enter_room(sid, room)
+
+async def leave_room_for_user(user_id, room):
+    for sid in list(registry.user_sockets.get(str(user_id), ())):
+        await sio.leave_room(sid, room)
+
+def user_from_environ(environ) -> Optional[str]:
+    """User id from the access_token cookie of the handshake request, None if it is missing or invalid"""
+    cookies = SimpleCookie(environ.get("HTTP_COOKIE", ""))
+    token = cookies["access_token"].value if "access_token" in cookies else None
+    if not token:
+        return None
+    try:
+        claims = verify_token(token)
+    except JWTError:
+        return None
+    return str(claims[1]) if claims else None
+
+# fn(sid, user_id) coroutines started in the background for every authenticated socket
+connect_hooks = []
+
+def on_user_connect(fn):
+    connect_hooks.append(fn)
+    return fn
 
 @sio.event
 async def connect(sid, environ):
-    print("Client connected:", sid)
-    # Extract query params
-    query = environ.get("QUERY_STRING", "")
-    params = dict(qc.split("=") for qc in query.split("&") if "=" in qc)
-    user_id = params.get("userId")
-    print("Connected userId:", user_id)
+    # The identity comes from the signed cookie, a userId query param is not trusted
+    user_id = user_from_environ(environ)
+    ip = environ_ip(environ)
+    # Before any presence or room work, a reconnect loop is refused here (unauthenticated ones by IP)
+    wait = limits["socket_connect"].acquire(user_id, ip)
+    if wait:
+        raise ConnectionRefusedError({"message": "Too many connections", "retry_after": retry_after(wait)})
+    if user_id is None:
+        raise ConnectionRefusedError("Not authenticated")
+    log.debug("socket connected", sid=sid, user_id=user_id)
+    await sio.save_session(sid, {"user_id": user_id, "ip": ip})
+
+    # Store as string for consistency
+    await sio.enter_room(sid, user_room(user_id))
+    came_online = await registry.add(user_id, sid)  # This will be "2", not 2
 
-    if user_id:
-        # Store as string for consistency
-        user_socket_map[user_id] = sid  # This will be "2", not 2
-        socket_user_map[sid] = user_id
+    # The new socket gets the full list once, everyone else a batched userOnline delta
+    await presence.snapshot(sid, user_id)
+    if came_online:
+        presence.user_online(user_id)
 
-    # Broadcast online users to all clients
-    await sio.emit("getOnlineUsers", list(user_socket_map.keys()))
+    for hook in connect_hooks:
+        sio.start_background_task(hook, sid, user_id)
 
 @sio.event
 async def disconnect(sid):
-    print("Client disconnected:", sid)
-    user_id = socket_user_map.get(sid)
-    
-
-    if user_id and user_id in user_socket_map:
-        del user_socket_map[user_id]
-
-    if sid in socket_user_map:
-        del socket_user_map[sid]
+    user_id, went_offline = await registry.remove(sid)
+    log.debug("socket disconnected", sid=sid, user_id=user_id)
 
-    # Broadcast updated list of online users
-    await sio.emit("getOnlineUsers", list(user_socket_map.keys()))
+    # Closing one of several devices keeps the user online
+    if went_offline:
+        presence.user_offline(user_id)
 
 @sio.event
 async def message(sid, data):
-    print(f"Message from {sid}: {data}")
+    log.debug("echo message", sid=sid)
     await sio.emit("message", f"Server got your message: {data}", room=sid)
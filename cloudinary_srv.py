@@ -3,6 +3,12 @@ import cloudinary.uploader
 import cloudinary.api
 import cloudinary.utils
 import os
+import shutil
+import tempfile
+import uuid
+from abc import ABC, abstractmethod
+from typing import Optional
+from PIL import Image, ImageOps, UnidentifiedImageError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,24 +20,149 @@ cloudinary.config(
     secure=True
 )
 
+MEDIA_BACKEND = os.getenv("MEDIA_BACKEND", "cloudinary")
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+MEDIA_URL = os.getenv("MEDIA_URL", "/media")
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(6 * 1024 * 1024)))
+# Longest side of the thumbnail variant chat bubbles load instead of the full image
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+
+
+def make_thumbnail(path: str) -> Optional[str]:
+    """
+    Temp JPEG of the image at path scaled to fit THUMBNAIL_SIZE, which the caller removes. Returns
+    path itself when the image already fits and None when the file is not an image.
+    """
+    try:
+        image = Image.open(path)
+    except (UnidentifiedImageError, OSError):
+        return None
+    with image:
+        if max(image.size) <= THUMBNAIL_SIZE:
+            return path
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as out:
+            image.save(out, "JPEG", quality=80, optimize=True)
+    return out.name
+
+
+class MediaStorage(ABC):
+    """
+    Blocking storage client. Results use Cloudinary's keys (secure_url, public_id)
+    whichever backend is configured.
+    """
+
+    @abstractmethod
+    def upload(self, file, folder: str) -> dict:
+        ...
+
+    @abstractmethod
+    def delete(self, public_id: str) -> dict:
+        ...
+
+    @abstractmethod
+    def url(self, public_id: str) -> str:
+        ...
+
+    def thumbnail(self, path: str, result: dict, folder: str) -> dict:
+        """
+        thumbnail_url / thumbnail_id of the upload `result` of the file at path. Images larger than
+        THUMBNAIL_SIZE get a stored variant, smaller ones reference the original, other files get none.
+        """
+        thumbnail_path = make_thumbnail(path)
+        if thumbnail_path is None:
+            return {}
+        if thumbnail_path == path:
+            return {"thumbnail_url": result["secure_url"], "thumbnail_id": None}
+        try:
+            variant = self.upload(thumbnail_path, f"{folder}/thumbnails")
+        finally:
+            os.remove(thumbnail_path)
+        return {"thumbnail_url": variant["secure_url"], "thumbnail_id": variant["public_id"]}
+
+
+class CloudinaryStorage(MediaStorage):
+
+    def upload(self, file, folder: str):
+        if isinstance(file, str):
+            # Chunked upload straight from disk instead of one request holding the whole file
+            return cloudinary.uploader.upload_large(file, folder=folder, resource_type="auto", chunk_size=UPLOAD_CHUNK_SIZE)
+        return cloudinary.uploader.upload(file, folder=folder, resource_type="auto")
+
+    def delete(self, public_id: str):
+        return cloudinary.uploader.destroy(public_id)
+
+    def url(self, public_id: str):
+        url, _ = cloudinary.utils.cloudinary_url(public_id, secure=True)
+        return url
+
+    def thumbnail(self, path: str, result: dict, folder: str):
+        # Cloudinary derives the variant on first request, nothing else to upload or delete
+        if result.get("resource_type", "image") != "image":
+            return {}
+        url, _ = cloudinary.utils.cloudinary_url(
+            result["public_id"], secure=True, width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE,
+            crop="limit", fetch_format="auto", quality="auto"
+        )
+        return {"thumbnail_url": url, "thumbnail_id": None}
+
+
+class LocalStorage(MediaStorage):
+    """Stores files under MEDIA_ROOT and serves them from MEDIA_URL, for offline runs"""
+
+    def __init__(self, root: str = MEDIA_ROOT, base_url: str = MEDIA_URL):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+
+    def upload(self, file, folder: str):
+        source_name = file if isinstance(file, str) else getattr(file, "name", "")
+        extension = os.path.splitext(source_name)[1] if isinstance(source_name, str) else ""
+        public_id = f"{folder}/{uuid.uuid4().hex}{extension}"
+        destination = os.path.join(self.root, public_id)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if isinstance(file, str):
+            shutil.copyfile(file, destination)
+        else:
+            with open(destination, "wb") as out:
+                shutil.copyfileobj(file, out, UPLOAD_CHUNK_SIZE)
+        return {"secure_url": self.url(public_id), "public_id": public_id}
+
+    def delete(self, public_id: str):
+        try:
+            os.remove(os.path.join(self.root, public_id))
+            return {"result": "ok"}
+        except FileNotFoundError:
+            return {"result": "not found"}
+
+    def url(self, public_id: str):
+        return f"{self.base_url}/{public_id}"
+
+
+def get_storage() -> MediaStorage:
+    if MEDIA_BACKEND == "local":
+        return LocalStorage()
+    if MEDIA_BACKEND == "cloudinary":
+        return CloudinaryStorage()
+    raise ValueError(f"Unknown MEDIA_BACKEND {MEDIA_BACKEND}")
+
+
+storage = get_storage()
 
 
 def get_profile_picture_url(public_id: str):
     if not public_id:
         return None
-    url, _ = cloudinary.utils.cloudinary_url(public_id, secure=True)
-    return url
+    return storage.url(public_id)
 
 def upload_file(file, folder="user_profiles"):
     """
-    Uploads a file to Cloudinary
+    Uploads a file (path or file object) to the configured storage
     """
     try:
-        result = cloudinary.uploader.upload(
-            file,
-            folder=folder,
-            resource_type="auto"  # auto detects image, video, raw
-        )
+        result = storage.upload(file, folder)
         return result
     except Exception as e:
         raise Exception(f"Upload failed: {str(e)}")
@@ -39,10 +170,10 @@ def upload_file(file, folder="user_profiles"):
 
 def delete_file(public_id: str):
     """
-    Deletes a file from Cloudinary using its public_id
+    Deletes a file from the configured storage using its public_id
     """
     try:
-        result = cloudinary.uploader.destroy(public_id)
+        result = storage.delete(public_id)
         return result
     except Exception as e:
-        raise Exception(f"Delete failed: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Delete failed: {str(e)}")
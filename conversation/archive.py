@@ -0,0 +1,183 @@
+"""
+Hot/cold message storage.
+
+message holds the recent history every read and write touches, message_archive the rest. A
+background task (MessageArchiver) moves messages older than MESSAGE_ARCHIVE_AFTER_DAYS across in
+batches, keeping their ids, so message and its indexes only grow with recent traffic.
+
+A message stays hot while anything still points at it or may still change it:
+- it is the last message of its conversation or group, the inbox joins it
+- it is undelivered, or not behind the receiver's read watermark (every member's, for a group),
+  backlog replay, unread counts and watermark lookups only look at message
+- its media is still uploading
+
+So archived messages are all strictly behind every read cursor and older than the horizon at the
+time they moved. History reads (get_messages, get_group_messages) query the archive only when a
+page reaches past the hot window, see reaches_archive. Search finds archived messages too: the
+SQLite FTS rows are keyed by message id and stay, on Postgres the archive has the same generated
+columns as message.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from time import perf_counter
+from typing import Callable, List, Optional
+from sqlalchemy import and_, delete, func, or_, select, text, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from database import SessionLocal, engine, upsert_insert, utcnow
+from logs import get_logger
+from metrics import Counter, Histogram
+from .enums import MediaStatus
+from .models import ArchivedMessage, ChatGroup, ConversationSummary, GroupMember, Message
+from dotenv import load_dotenv
+load_dotenv()
+
+MESSAGE_ARCHIVE_AFTER_DAYS = float(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "90"))
+# Seconds between archive runs, 0 turns the task off (reads still look past the horizon)
+MESSAGE_ARCHIVE_INTERVAL = float(os.getenv("MESSAGE_ARCHIVE_INTERVAL", "3600"))
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.getenv("MESSAGE_ARCHIVE_BATCH_SIZE", "1000"))
+
+log = get_logger("conversation.archive")
+messages_archived = Counter("messages_archived_total", "Messages moved from message to message_archive")
+archive_run_duration = Histogram("message_archive_run_seconds", "Duration of an archive run, compaction included",
+                                 (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0))
+archive_reads = Counter("message_archive_reads_total", "History pages that also read message_archive")
+
+ARCHIVE_COLUMNS = [column.name for column in ArchivedMessage.__table__.columns]
+
+
+def archive_horizon() -> datetime:
+    """Every archived message is older than this"""
+    return utcnow() - timedelta(days=MESSAGE_ARCHIVE_AFTER_DAYS)
+
+
+def reaches_archive(rows: list, keyset, forward: bool, limit: int) -> bool:
+    """
+    Whether a history page read from message (up to limit + 1 rows in the direction of travel) may
+    be missing archived messages. Walking forward from a position inside the hot window, or back
+    through a full page that ends inside it, never can.
+    """
+    horizon = archive_horizon()
+    if forward:
+        return keyset[0] < horizon
+    return len(rows) <= limit or rows[-1].created_at < horizon
+
+
+def merge_tiers(hot: list, cold: list, forward: bool, limit: int) -> list:
+    """The first limit + 1 rows of both tiers in the direction of travel"""
+    rows = sorted(hot + cold, key=lambda row: (row.created_at, row.id), reverse=not forward)
+    archive_reads.inc()
+    return rows[:limit + 1]
+
+
+def archivable(before_id: int, cutoff: datetime, after_id: int, batch_size: int):
+    """Ids of up to batch_size messages that can move, in id order within (after_id, before_id)"""
+    sent = aliased(ConversationSummary)
+    received = aliased(ConversationSummary)
+    candidates = and_(Message.id > after_id, Message.id < before_id, Message.created_at < cutoff,
+                      or_(Message.media_status.is_(None), Message.media_status != MediaStatus.Pending))
+    direct = select(Message.id) \
+        .join(sent, and_(sent.user_id == Message.sender_id, sent.peer_id == Message.receiver_id)) \
+        .join(received, and_(received.user_id == Message.receiver_id, received.peer_id == Message.sender_id)) \
+        .where(candidates, Message.delivered_at.isnot(None),
+               Message.id < sent.last_message_id, Message.id < received.last_read_message_id)
+    # Behind the cursor of the member furthest behind, so every member's cursor message stays hot
+    slowest_cursor = select(func.min(GroupMember.last_read_message_id)) \
+        .where(GroupMember.group_id == Message.group_id).correlate(Message).scalar_subquery()
+    group = select(Message.id).join(ChatGroup, ChatGroup.id == Message.group_id) \
+        .where(candidates, Message.id < ChatGroup.last_message_id, Message.id < slowest_cursor)
+    ids = union_all(direct, group).subquery()
+    return select(ids.c.id).order_by(ids.c.id).limit(batch_size)
+
+
+async def archive_bound(db: AsyncSession, cutoff: datetime) -> Optional[int]:
+    """
+    Id of the oldest message newer than cutoff. Ids grow with time, so only ids below it can be
+    archived, and finding it walks the primary key over the old rows still hot, not the whole table.
+    """
+    return await db.scalar(select(Message.id).where(Message.created_at >= cutoff).order_by(Message.id).limit(1))
+
+
+async def archive_batch(db: AsyncSession, ids: List[int]):
+    """Copies the messages into message_archive and deletes them from message, in one transaction"""
+    copy = upsert_insert(db)(ArchivedMessage).from_select(
+        ARCHIVE_COLUMNS, select(*(Message.__table__.c[name] for name in ARCHIVE_COLUMNS)).where(Message.id.in_(ids))
+    )
+    # Another process may have moved the same batch
+    await db.execute(copy.on_conflict_do_nothing(index_elements=[ArchivedMessage.id]))
+    await db.execute(delete(Message).where(Message.id.in_(ids)))
+
+
+async def compact():
+    """Fresh planner statistics for the shrunken hot table and its space made reusable"""
+    async with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            # Plain VACUUM does not block reads or writes, it cannot run in a transaction
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await conn.execute(text("VACUUM (ANALYZE) message"))
+            return
+        # SQLite puts the freed pages on its freelist, new messages are written into them
+        await conn.execute(text("ANALYZE message"))
+        await conn.commit()
+
+
+class MessageArchiver:
+
+    def __init__(self, session_factory: Callable[[], AsyncSession], interval: float = MESSAGE_ARCHIVE_INTERVAL,
+                 batch_size: int = MESSAGE_ARCHIVE_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.interval = interval
+        self.batch_size = batch_size
+        self._task = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run_forever())
+
+    async def _run_forever(self):
+        while True:
+            try:
+                await self.run()
+            except Exception:
+                log.exception("message archive run failed")
+            await asyncio.sleep(self.interval)
+
+    async def run(self) -> int:
+        """Moves every message that can go, a batch per transaction, returns how many moved"""
+        started = perf_counter()
+        cutoff = archive_horizon()
+        moved, after_id = 0, 0
+        async with self.session_factory() as db:
+            before_id = await archive_bound(db, cutoff)
+            if before_id is None:
+                # Nothing newer than the cutoff, everything is a candidate
+                before_id = (await db.scalar(select(func.max(Message.id))) or 0) + 1
+            while True:
+                ids = (await db.scalars(archivable(before_id, cutoff, after_id, self.batch_size))).all()
+                if not ids:
+                    break
+                await archive_batch(db, ids)
+                await db.commit()
+                moved += len(ids)
+                after_id = ids[-1]
+                messages_archived.inc(len(ids))
+                # Let requests in between batches
+                await asyncio.sleep(0)
+        if moved:
+            await compact()
+            log.info("messages archived", moved=moved, cutoff=cutoff.isoformat())
+        archive_run_duration.observe(perf_counter() - started)
+        return moved
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+message_archiver = MessageArchiver(SessionLocal)
@@ -0,0 +1,108 @@
+"""
+Group commit for message inserts.
+
+With MESSAGE_WRITE_MODE=batched, concurrent create_message calls are queued and written together:
+a batch is flushed once it holds MESSAGE_BATCH_MAX_SIZE messages or MESSAGE_BATCH_MAX_DELAY_MS after
+its first message arrived, using one multi-row INSERT ... RETURNING, the inbox upserts and one COMMIT.
+While a batch commits the next one keeps filling up, so the disk sees one sync per batch.
+
+Durability (MESSAGE_BATCH_DURABILITY):
+  commit        every caller resumes only after the COMMIT of its batch returned, exactly as durable
+                as the per-message path. A failed batch fails every caller in it. (default)
+  async_commit  Postgres runs the batch with synchronous_commit off: the COMMIT returns before the WAL
+                is flushed, a server crash can lose the last few hundred ms of acknowledged messages
+                but never leaves a partial batch. SQLite keeps following its synchronous pragma.
+"""
+import asyncio
+import os
+from time import perf_counter
+from typing import Awaitable, Callable, List, Tuple
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from .models import Message
+from metrics import Histogram
+from dotenv import load_dotenv
+load_dotenv()
+
+MESSAGE_WRITE_MODE = os.getenv("MESSAGE_WRITE_MODE", "immediate")
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv("MESSAGE_BATCH_MAX_SIZE", "100"))
+MESSAGE_BATCH_MAX_DELAY_MS = float(os.getenv("MESSAGE_BATCH_MAX_DELAY_MS", "5"))
+MESSAGE_BATCH_DURABILITY = os.getenv("MESSAGE_BATCH_DURABILITY", "commit")
+
+batch_size = Histogram("message_batch_size", "Messages written per group commit", (1, 2, 5, 10, 25, 50, 100, 250, 500))
+batch_flush_duration = Histogram("message_batch_flush_seconds", "Insert plus commit time of one group commit")
+
+# Columns the caller sets, everything else comes back from RETURNING
+_INSERT_COLUMNS = ("sender_id", "receiver_id", "content", "image_url", "image_id", "thumbnail_url", "media_status")
+
+
+class MessageBatcher:
+
+    def __init__(self, session_factory: Callable[[], AsyncSession],
+                 after_insert: Callable[[AsyncSession, List[Message]], Awaitable[None]],
+                 max_size: int = MESSAGE_BATCH_MAX_SIZE, max_delay: float = MESSAGE_BATCH_MAX_DELAY_MS / 1000,
+                 durability: str = MESSAGE_BATCH_DURABILITY):
+        if durability not in ("commit", "async_commit"):
+            raise ValueError(f"Unknown MESSAGE_BATCH_DURABILITY {durability}")
+        self.session_factory = session_factory
+        self.after_insert = after_insert
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.durability = durability
+        self._pending: List[Tuple[Message, asyncio.Future]] = []
+        self._timer = None
+        self._flusher = None
+
+    async def submit(self, message: Message) -> Message:
+        """Queues a transient Message and returns it with id and timestamps once its batch committed"""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.max_size:
+            self._kick()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._kick)
+        return await future
+
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_size], self._pending[self.max_size:]
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[Message, asyncio.Future]]):
+        started_at = perf_counter()
+        messages = [message for message, _ in batch]
+        try:
+            async with self.session_factory() as db:
+                if self.durability == "async_commit" and db.get_bind().dialect.name == "postgresql":
+                    await db.execute(text("SET LOCAL synchronous_commit TO OFF"))
+                result = await db.execute(
+                    insert(Message).returning(Message.id, Message.created_at, Message.updated_at, sort_by_parameter_order=True),
+                    [{column: getattr(message, column) for column in _INSERT_COLUMNS} for message in messages]
+                )
+                for message, row in zip(messages, result.all()):
+                    message.id, message.created_at, message.updated_at = row
+                await self.after_insert(db, messages)
+                await db.commit()
+        except Exception as exp:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exp)
+            return
+        batch_size.observe(len(batch))
+        batch_flush_duration.observe(perf_counter() - started_at)
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+    async def close(self):
+        if self._pending:
+            self._kick()
+        if self._flusher is not None:
+            await self._flusher
@@ -0,0 +1,97 @@
+"""
+Offline delivery. A message counts as delivered once a socket of its receiver acked it, until
+then message.delivered_at stays NULL and the row sits in the partial ix_message_undelivered_direct
+index. Group messages have no single receiver and are not in it, members catch up through history.
+
+When a socket connects the backlog is pushed as messageBacklog events of DELIVERY_BATCH_SIZE
+messages. Each is a Socket.IO call: the client acks with the list of ids it stored, those are marked
+delivered in one UPDATE, and only then the next batch goes out. No ack within DELIVERY_ACK_TIMEOUT
+stops the replay, the remainder waits for the next connect. Live newMessage events are acked the
+same way through ackMessages. Delivery is at least once, clients drop ids they already have.
+"""
+import os
+from typing import Iterable, List
+from socketio.exceptions import TimeoutError
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from chat_socket import on_user_connect, sio
+from database import SessionLocal, utcnow
+from metrics import Counter
+from .models import Message
+from .service import MESSAGE_COLUMNS, message_payload
+from dotenv import load_dotenv
+load_dotenv()
+
+DELIVERY_BATCH_SIZE = int(os.getenv("DELIVERY_BATCH_SIZE", "100"))
+DELIVERY_ACK_TIMEOUT = float(os.getenv("DELIVERY_ACK_TIMEOUT", "10"))
+# Upper bound on ids taken from one ack
+MAX_ACK_IDS = 1000
+
+backlog_batches = Counter("message_backlog_batches_total", "messageBacklog batches by outcome")
+messages_delivered = Counter("messages_delivered_total", "Messages marked delivered from client acks")
+
+
+async def get_undelivered(db: AsyncSession, user_id: int, after_id: int, limit: int):
+    result = await db.execute(
+        select(*MESSAGE_COLUMNS)
+        .where(Message.receiver_id == user_id, Message.delivered_at.is_(None), Message.id > after_id)
+        .order_by(Message.id)
+        .limit(limit)
+    )
+    return result.all()
+
+
+async def mark_delivered(user_id: int, ids: Iterable) -> int:
+    """One UPDATE for a whole ack, ids that are not the user's or already delivered are ignored"""
+    ids = list({id for id in ids if isinstance(id, int) and not isinstance(id, bool)})[:MAX_ACK_IDS]
+    if not ids:
+        return 0
+    async with SessionLocal() as db:
+        result = await db.execute(
+            update(Message)
+            .where(Message.id.in_(ids), Message.receiver_id == user_id, Message.delivered_at.is_(None))
+            .values(delivered_at=utcnow())
+        )
+        await db.commit()
+    messages_delivered.inc(result.rowcount)
+    return result.rowcount
+
+
+@on_user_connect
+async def replay_backlog(sid: str, user_id: str):
+    uid, after_id = int(user_id), 0
+    while True:
+        async with SessionLocal() as db:
+            rows = await get_undelivered(db, uid, after_id, DELIVERY_BATCH_SIZE + 1)
+        if not rows:
+            return
+        batch: List[dict] = [message_payload(row) for row in rows[:DELIVERY_BATCH_SIZE]]
+        try:
+            acked = await sio.call("messageBacklog", {"messages": batch, "more": len(rows) > DELIVERY_BATCH_SIZE},
+                                   to=sid, timeout=DELIVERY_ACK_TIMEOUT, ignore_queue=True)
+        except TimeoutError:
+            backlog_batches.inc(outcome="timeout")
+            return
+        sent_ids = {message["id"] for message in batch}
+        # Whatever the client sent back, unhashable elements included
+        acked_ids = [
+            id for id in acked if isinstance(id, int) and not isinstance(id, bool) and id in sent_ids
+        ] if isinstance(acked, list) else []
+        if not acked_ids:
+            backlog_batches.inc(outcome="rejected")
+            return
+        await mark_delivered(uid, acked_ids)
+        backlog_batches.inc(outcome="acked")
+        after_id = batch[-1]["id"]
+        if len(rows) <= DELIVERY_BATCH_SIZE:
+            return
+
+
+@sio.on("ackMessages")
+async def ack_messages(sid, data):
+    """Client confirms live newMessage events: {"ids": [...]}, acked with the number newly marked"""
+    session = await sio.get_session(sid)
+    ids = data.get("ids") if isinstance(data, dict) else None
+    if not isinstance(ids, list):
+        return {"ok": False, "error": "ids must be a list of message ids"}
+    return {"ok": True, "delivered": await mark_delivered(int(session["user_id"]), ids)}
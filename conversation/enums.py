@@ -0,0 +1,6 @@
+from enum import Enum
+
+class MediaStatus(str, Enum):
+    Pending = "pending"
+    Ready = "ready"
+    Failed = "failed"
@@ -0,0 +1,88 @@
+from fastapi import HTTPException
+from pydantic import ValidationError
+from chat_socket import sio
+from database import SessionLocal
+from auth.cache import user_cache
+from auth.service import get_user_by_id
+from .schemas import GroupMessageSend, MessageSend
+from .groups import create_group_message
+from .service import create_message
+from logs import get_logger
+from rate_limit import limits, retry_after
+
+log = get_logger("conversation.events")
+
+
+async def rate_limited(sid, session, event: str, limit: str, client_id):
+    """Error ack for an event over its limit, None when it may go ahead. The socket also gets rateLimited"""
+    wait = limits[limit].acquire(session["user_id"], session.get("ip"))
+    if not wait:
+        return None
+    await sio.emit("rateLimited", {"event": event, "retry_after": retry_after(wait)}, to=sid)
+    return {"ok": False, "error": "Too many requests", "retry_after": retry_after(wait), "client_id": client_id}
+
+
+@sio.on("sendMessage")
+async def send_message(sid, data):
+    """
+    Text message over the live socket. The sender comes from the session saved at connect,
+    persistence and the newMessage fan-out are the same create_message the REST route uses.
+    The return value is the ack: {"ok": true, "id", "created_at", "client_id"} or {"ok": false, "error"}.
+    """
+    session = await sio.get_session(sid)
+    try:
+        payload = MessageSend.model_validate(data)
+    except ValidationError as exp:
+        return {"ok": False, "error": "Invalid message", "details": exp.errors(include_url=False, include_context=False)}
+    if not payload.content.strip():
+        return {"ok": False, "error": "Message must contain text", "client_id": payload.client_id}
+    limited = await rate_limited(sid, session, "sendMessage", "socket_send_message", payload.client_id)
+    if limited:
+        return limited
+
+    try:
+        async with SessionLocal() as db:
+            if user_cache.get(payload.receiver_id) is None and not await get_user_by_id(db, payload.receiver_id):
+                return {"ok": False, "error": "User not found", "client_id": payload.client_id}
+            message = await create_message(db, int(session["user_id"]), payload.receiver_id, payload.content, None)
+    except Exception:
+        log.exception("sendMessage failed", sid=sid)
+        return {"ok": False, "error": "Message could not be saved", "client_id": payload.client_id}
+
+    return {
+        "ok": True,
+        "id": message.id,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+        "client_id": payload.client_id
+    }
+
+
+@sio.on("sendGroupMessage")
+async def send_group_message(sid, data):
+    """Like sendMessage for a group the sender is a member of, fanned out as newGroupMessage"""
+    session = await sio.get_session(sid)
+    try:
+        payload = GroupMessageSend.model_validate(data)
+    except ValidationError as exp:
+        return {"ok": False, "error": "Invalid message", "details": exp.errors(include_url=False, include_context=False)}
+    if not payload.content.strip():
+        return {"ok": False, "error": "Message must contain text", "client_id": payload.client_id}
+    limited = await rate_limited(sid, session, "sendGroupMessage", "socket_send_group_message", payload.client_id)
+    if limited:
+        return limited
+
+    try:
+        async with SessionLocal() as db:
+            message = await create_group_message(db, int(session["user_id"]), payload.group_id, payload.content)
+    except HTTPException as htp_err:
+        return {"ok": False, "error": htp_err.detail, "client_id": payload.client_id}
+    except Exception:
+        log.exception("sendGroupMessage failed", sid=sid)
+        return {"ok": False, "error": "Message could not be saved", "client_id": payload.client_id}
+
+    return {
+        "ok": True,
+        "id": message.id,
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+        "client_id": payload.client_id
+    }
@@ -0,0 +1,209 @@
+"""
+Group conversations.
+
+A group message is one message row with group_id set and receiver_id NULL, written once whatever
+the group size. Delivery is one emit to the group's Socket.IO room (chat_socket.group_room), which
+every socket of every member joins at connect or when the member is added. Each member keeps a
+read cursor on group_member, the same kind of watermark as conversation_summary.last_read_message_id.
+
+Group messages are not part of the offline delivery queue, members catch up from history with `since`.
+"""
+import os
+from datetime import datetime
+from typing import Iterable, Optional
+from fastapi import HTTPException
+from starlette import status
+from sqlalchemy import and_, case, delete, func, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from auth.models import User
+from chat_socket import group_room, join_room_for_user, leave_room_for_user, on_user_connect, send_group_message, sio
+from database import SessionLocal, upsert_insert
+from .archive import merge_tiers, reaches_archive
+from .models import ArchivedMessage, ChatGroup, GroupMember, Message
+from .search import index_messages
+from .service import ARCHIVE_COLUMNS, MAX_MESSAGE_PAGE_SIZE, MESSAGE_COLUMNS, MESSAGE_PAGE_SIZE, message_page, message_payload, resolve_keyset
+from dotenv import load_dotenv
+load_dotenv()
+
+GROUP_MAX_MEMBERS = int(os.getenv("GROUP_MAX_MEMBERS", "1000"))
+
+
+async def require_membership(db: AsyncSession, group_id: int, user_id: int) -> GroupMember:
+    """Non-members get the same 404 as a missing group"""
+    member = await db.get(GroupMember, (group_id, user_id))
+    if member is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Group not found")
+    return member
+
+
+def unread_count_query(member):
+    """Messages of the member's group after its read cursor, a range of ix_message_group"""
+    watermark = aliased(Message)
+    read_at = select(watermark.created_at).where(watermark.id == member.last_read_message_id) \
+        .correlate_except(watermark).scalar_subquery()
+    # A cursor of 0 has no message behind it, everything in the group is unread
+    position = tuple_(func.coalesce(read_at, datetime.min), member.last_read_message_id)
+    return select(func.count()).select_from(Message).where(
+        Message.group_id == member.group_id,
+        tuple_(Message.created_at, Message.id) > position
+    )
+
+
+async def get_groups(db: AsyncSession, user_id: int):
+    member_count = select(func.count()).where(GroupMember.group_id == ChatGroup.id).correlate(ChatGroup).scalar_subquery()
+    member = aliased(GroupMember)
+    unread = unread_count_query(member).correlate(member).scalar_subquery()
+    rows = (await db.execute(
+        select(ChatGroup, member.last_read_message_id, member_count, unread)
+        .join(member, and_(member.group_id == ChatGroup.id, member.user_id == user_id))
+        .order_by(ChatGroup.last_activity_at.desc(), ChatGroup.id.desc())
+    )).all()
+    return {"groups": [group_out(group, member_count, last_read, unread) for group, last_read, member_count, unread in rows]}
+
+
+def group_out(group: ChatGroup, member_count: int, last_read_message_id: int = 0, unread_count: int = 0) -> dict:
+    return {
+        "id": group.id,
+        "name": group.name,
+        "created_by": group.created_by,
+        "last_message_id": group.last_message_id,
+        "last_activity_at": group.last_activity_at,
+        "member_count": member_count,
+        "last_read_message_id": last_read_message_id,
+        "unread_count": unread_count
+    }
+
+
+async def check_new_members(db: AsyncSession, member_ids: Iterable[int], current_count: int) -> set:
+    member_ids = set(member_ids)
+    if current_count + len(member_ids) > GROUP_MAX_MEMBERS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"A group has at most {GROUP_MAX_MEMBERS} members")
+    found = set((await db.scalars(select(User.id).where(User.id.in_(member_ids)))).all())
+    if found != member_ids:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found")
+    return member_ids
+
+
+async def create_group(db: AsyncSession, creator_id: int, name: str, member_ids: Iterable[int]) -> dict:
+    member_ids = await check_new_members(db, set(member_ids) | {creator_id}, 0)
+    group = ChatGroup(name=name, created_by=creator_id)
+    db.add(group)
+    await db.flush()
+    db.add_all([GroupMember(group_id=group.id, user_id=user_id, last_read_message_id=0) for user_id in member_ids])
+    await db.commit()
+
+    for user_id in member_ids:
+        await join_room_for_user(user_id, group_room(group.id))
+    out = group_out(group, len(member_ids))
+    await sio.emit("groupMembersAdded", {"group_id": group.id, "member_ids": sorted(member_ids)}, room=group_room(group.id))
+    return out
+
+
+async def add_group_members(db: AsyncSession, group_id: int, user_id: int, member_ids: Iterable[int]) -> dict:
+    await require_membership(db, group_id, user_id)
+    group = await db.get(ChatGroup, group_id)
+    existing = set((await db.scalars(select(GroupMember.user_id).where(GroupMember.group_id == group_id))).all())
+    new_ids = await check_new_members(db, set(member_ids) - existing, len(existing))
+    if new_ids:
+        # History from before joining does not count as unread
+        stmt = upsert_insert(db)(GroupMember).on_conflict_do_nothing(index_elements=[GroupMember.group_id, GroupMember.user_id])
+        await db.execute(stmt, [{"group_id": group_id, "user_id": new_id, "last_read_message_id": group.last_message_id or 0}
+                                for new_id in new_ids])
+        await db.commit()
+        for new_id in new_ids:
+            await join_room_for_user(new_id, group_room(group_id))
+        await sio.emit("groupMembersAdded", {"group_id": group_id, "member_ids": sorted(new_ids)}, room=group_room(group_id))
+    return group_out(group, len(existing | new_ids))
+
+
+async def leave_group(db: AsyncSession, group_id: int, user_id: int):
+    await require_membership(db, group_id, user_id)
+    await db.execute(delete(GroupMember).where(GroupMember.group_id == group_id, GroupMember.user_id == user_id))
+    await db.commit()
+    await leave_room_for_user(user_id, group_room(group_id))
+    await sio.emit("groupMemberLeft", {"group_id": group_id, "member_id": user_id}, room=group_room(group_id))
+
+
+async def create_group_message(db: AsyncSession, sender_id: int, group_id: int, content: str) -> Message:
+    """One row, one group update and one room emit, independent of the member count"""
+    await require_membership(db, group_id, sender_id)
+    message = Message(sender_id=sender_id, group_id=group_id, content=content)
+    db.add(message)
+    await db.flush()
+    # A commit that lands late must not replace a newer last message
+    is_newer = or_(ChatGroup.last_message_id.is_(None), ChatGroup.last_message_id < message.id)
+    await db.execute(
+        update(ChatGroup).where(ChatGroup.id == group_id).values(
+            last_message_id=case((is_newer, message.id), else_=ChatGroup.last_message_id),
+            last_activity_at=case((is_newer, message.created_at), else_=ChatGroup.last_activity_at)
+        )
+    )
+    # The sender has read their own message
+    await db.execute(
+        update(GroupMember)
+        .where(GroupMember.group_id == group_id, GroupMember.user_id == sender_id, GroupMember.last_read_message_id < message.id)
+        .values(last_read_message_id=message.id)
+    )
+    await index_messages(db, [message])
+    await db.commit()
+
+    await send_group_message(group_id, message_payload(message))
+    return message
+
+
+async def get_group_messages(db: AsyncSession, group_id: int, user_id: int, before: Optional[str] = None,
+                             after: Optional[str] = None, limit: int = MESSAGE_PAGE_SIZE, since: Optional[str] = None):
+    """Same paging as get_messages, a single walk of ix_message_group while the page is in the hot window"""
+    await require_membership(db, group_id, user_id)
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    keyset, forward = await resolve_keyset(db, before, after, since)
+
+    def group_page(model, columns):
+        query = select(*columns).where(model.group_id == group_id)
+        position = tuple_(model.created_at, model.id)
+        if forward:
+            query = query.where(position > keyset).order_by(model.created_at.asc(), model.id.asc())
+        else:
+            if before:
+                query = query.where(position < keyset)
+            query = query.order_by(model.created_at.desc(), model.id.desc())
+        return query.limit(limit + 1)
+
+    rows = (await db.execute(group_page(Message, MESSAGE_COLUMNS))).all()
+    if reaches_archive(rows, keyset, forward, limit):
+        cold = (await db.execute(group_page(ArchivedMessage, ARCHIVE_COLUMNS))).all()
+        rows = merge_tiers(rows, cold, forward, limit)
+    return message_page(rows, limit, forward, bool(before))
+
+
+async def mark_group_read(db: AsyncSession, group_id: int, user_id: int, message_id: int) -> dict:
+    """Moves the member's cursor forward to a message of the group, then tells the group"""
+    member = await require_membership(db, group_id, user_id)
+    in_group = await db.scalar(select(Message.id).where(Message.id == message_id, Message.group_id == group_id))
+    if in_group is None:
+        in_group = await db.scalar(
+            select(ArchivedMessage.id).where(ArchivedMessage.id == message_id, ArchivedMessage.group_id == group_id)
+        )
+    if in_group is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Message is not part of this group")
+    result = await db.execute(
+        update(GroupMember)
+        .where(GroupMember.group_id == group_id, GroupMember.user_id == user_id, GroupMember.last_read_message_id < message_id)
+        .values(last_read_message_id=message_id)
+    )
+    await db.commit()
+    await db.refresh(member)
+    if result.rowcount:
+        await sio.emit("groupMessagesRead", {"group_id": group_id, "reader_id": user_id, "last_read_message_id": message_id},
+                       room=group_room(group_id))
+    unread = await db.scalar(unread_count_query(member))
+    return {"group_id": group_id, "last_read_message_id": member.last_read_message_id, "unread_count": unread}
+
+
+@on_user_connect
+async def join_group_rooms(sid: str, user_id: str):
+    async with SessionLocal() as db:
+        group_ids = (await db.scalars(select(GroupMember.group_id).where(GroupMember.user_id == int(user_id)))).all()
+    for group_id in group_ids:
+        await sio.enter_room(sid, group_room(group_id))
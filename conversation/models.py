@@ -1,19 +1,96 @@
-from datetime import datetime, timezone
-from sqlalchemy import Column, String, Integer, ForeignKey, DateTime
+from sqlalchemy import Column, String, Integer, ForeignKey, DateTime, Enum, Index, text
 from sqlalchemy.orm import relationship
-from database import Base
+from database import Base, utcnow
+from .enums import MediaStatus
 
-class Message(Base):
-    __tablename__ = "message"
-    
+class MessageColumns:
+    """Columns of a message in either tier, message_archive rows keep the id they had in message"""
     id = Column(Integer, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"))
-    receiver_id = Column(Integer, ForeignKey("users.id"))
+    receiver_id = Column(Integer, ForeignKey("users.id"))  # None for group messages
+    group_id = Column(Integer, ForeignKey("chat_group.id"), nullable=True)  # Written once, not per member
     content = Column(String, nullable=True)
     image_url = Column(String, nullable=True)  
     image_id = Column(String, nullable=True)   
-    created_at = Column(DateTime, default=datetime.now(timezone.utc))
-    updated_at = Column(DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
-    
-    sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
-    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+    thumbnail_url = Column(String, nullable=True)  # Size-bounded variant of image_url for chat bubbles
+    media_status = Column(Enum(MediaStatus), nullable=True)  # None for text-only messages
+    # Set once a socket of the receiver acked the message, history from before it was tracked counts as delivered
+    delivered_at = Column(DateTime, nullable=True, info={"backfill": "created_at"})
+    created_at = Column(DateTime, default=utcnow)
+    updated_at = Column(DateTime, default=utcnow, onupdate=utcnow)
+
+
+class Message(MessageColumns, Base):
+    """The hot tier, see conversation.archive for what moves out of it"""
+    __tablename__ = "message"
+    __table_args__ = (
+        # Serves both directions of a conversation and the keyset cursor on (created_at, id)
+        Index("ix_message_conversation", "sender_id", "receiver_id", "created_at", "id"),
+        # Group history and per-member unread counts, keyset on (created_at, id) like direct messages
+        Index("ix_message_group", "group_id", "created_at", "id"),
+        # Only undelivered direct messages are indexed, so the offline backlog of a user is a short range
+        # scan. Group messages are never delivered per receiver, they would stay in it forever
+        Index("ix_message_undelivered_direct", "receiver_id", "id",
+              sqlite_where=text("receiver_id IS NOT NULL AND delivered_at IS NULL"),
+              postgresql_where=text("receiver_id IS NOT NULL AND delivered_at IS NULL")),
+        # Dropped by create_tables, ix_message_undelivered indexed group messages too
+        {"info": {"retired_indexes": ["ix_message_undelivered"]}},
+    )
+
+    sender = relationship("User", foreign_keys="Message.sender_id", back_populates="sent_messages")
+    receiver = relationship("User", foreign_keys="Message.receiver_id", back_populates="received_messages")
+
+
+class ArchivedMessage(MessageColumns, Base):
+    """The cold tier, read by history only past the hot window"""
+    __tablename__ = "message_archive"
+    __table_args__ = (
+        Index("ix_message_archive_conversation", "sender_id", "receiver_id", "created_at", "id"),
+        Index("ix_message_archive_group", "group_id", "created_at", "id"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+
+class ConversationSummary(Base):
+    """One row per (user, peer) pair, kept current by create_message for the inbox"""
+    __tablename__ = "conversation_summary"
+    __table_args__ = (
+        Index("ix_conversation_summary_inbox", "user_id", "last_activity_at", "peer_id"),
+    )
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    peer_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_message_id = Column(Integer, ForeignKey("message.id"), nullable=False)
+    last_activity_at = Column(DateTime, nullable=False)
+    unread_count = Column(Integer, nullable=False, default=0)
+    # Read watermark: user_id has read every message from peer_id up to and including this id
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    # Bumped on both rows of a pair whenever the history between them changes, the history ETag
+    version = Column(Integer, nullable=False, default=0)
+
+
+class ChatGroup(Base):
+    __tablename__ = "chat_group"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String, nullable=False)
+    created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
+    last_message_id = Column(Integer, nullable=True)
+    last_activity_at = Column(DateTime, default=utcnow)
+    created_at = Column(DateTime, default=utcnow)
+
+
+class GroupMember(Base):
+    """Membership plus the member's read cursor"""
+    __tablename__ = "group_member"
+    __table_args__ = (
+        # The groups of a user, for the group list and for joining rooms at connect
+        Index("ix_group_member_user", "user_id", "group_id"),
+    )
+
+    group_id = Column(Integer, ForeignKey("chat_group.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    # Same watermark as conversation_summary.last_read_message_id
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    joined_at = Column(DateTime, default=utcnow)
@@ -0,0 +1,95 @@
+"""
+Read receipts.
+
+Reading is a watermark per conversation (conversation_summary.last_read_message_id), not a flag
+per message. Clients send markRead with the newest message id on screen, which while scrolling
+means a burst of events. They are coalesced here: marks are held for READ_FLUSH_INTERVAL_MS, only
+the highest id per conversation survives, and the window is written as one UPDATE per conversation
+in a single transaction. The senders get messagesRead once it committed.
+"""
+import asyncio
+import os
+from typing import Awaitable, Callable, Dict, List, Tuple
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from chat_socket import sio
+from database import SessionLocal
+from metrics import Counter, Histogram
+from .schemas import MarkRead
+from .service import apply_read_marks, notify_messages_read
+from logs import get_logger
+from dotenv import load_dotenv
+load_dotenv()
+
+READ_FLUSH_INTERVAL_MS = float(os.getenv("READ_FLUSH_INTERVAL_MS", "500"))
+
+log = get_logger("conversation.receipts")
+read_marks_received = Counter("read_marks_received_total", "markRead events received")
+read_flush_size = Histogram("read_flush_conversations", "Conversations written per read receipt flush", (1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+
+class ReadReceiptCoalescer:
+
+    def __init__(self, session_factory: Callable[[], AsyncSession],
+                 on_flushed: Callable[[List[Tuple[int, int, int]]], Awaitable[None]],
+                 flush_interval: float = READ_FLUSH_INTERVAL_MS / 1000):
+        self.session_factory = session_factory
+        self.on_flushed = on_flushed
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._timer = None
+        self._flusher = None
+
+    def mark(self, user_id: int, peer_id: int, message_id: int):
+        key = (user_id, peer_id)
+        if message_id > self._pending.get(key, 0):
+            self._pending[key] = message_id
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._kick)
+
+    def _kick(self):
+        self._timer = None
+        # A flush still running picks the new marks up when it finishes
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        marks, self._pending = self._pending, {}
+        try:
+            async with self.session_factory() as db:
+                advanced = await apply_read_marks(db, marks)
+                await db.commit()
+        except Exception:
+            # Dropped, the next markRead of the conversation carries a newer id anyway
+            log.exception("read receipt flush failed", conversations=len(marks))
+            advanced = []
+        finally:
+            if self._pending and self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._kick)
+        read_flush_size.observe(len(marks))
+        await self.on_flushed(advanced)
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flusher is not None:
+            await self._flusher
+        if self._pending:
+            await self._flush()
+
+
+read_receipts = ReadReceiptCoalescer(SessionLocal, notify_messages_read)
+
+
+@sio.on("markRead")
+async def mark_read(sid, data):
+    """{"peer_id", "message_id"}: everything from peer_id up to message_id has been read"""
+    session = await sio.get_session(sid)
+    try:
+        payload = MarkRead.model_validate(data)
+    except ValidationError as exp:
+        return {"ok": False, "error": "Invalid read mark", "details": exp.errors(include_url=False, include_context=False)}
+    read_marks_received.inc()
+    read_receipts.mark(int(session["user_id"]), payload.peer_id, payload.message_id)
+    return {"ok": True}
@@ -1,16 +1,21 @@
-from fastapi import APIRouter, Form, HTTPException, Depends, Path, UploadFile, File
-from typing import List, Optional
+from fastapi import APIRouter, Form, HTTPException, Depends, Path, Query, Request, Response, UploadFile, File
+from typing import Optional
 from typing import Annotated
 from starlette import status
-from sqlalchemy.orm import Session
-from database import get_db
-from auth.service import get_current_user
-from .schemas import MessageCreate, MessageOut
-from auth.models import User
-from cloudinary_srv import upload_file
-from .service import create_message, get_messages
-
-db_dependency = Annotated[Session, Depends(get_db)]
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_db, get_read_db
+from auth.service import get_current_user, get_user_by_id
+from .schemas import ConversationPage, GroupCreate, GroupList, GroupMembersAdd, GroupOut, GroupRead, GroupReadState, MarkRead, MessageOut, MessagePage, MessageSearchPage, ReadState
+from functools import partial
+from media_pipeline import upload_pipeline
+from etag import etag_matches, make_etag, not_modified, query_key, set_etag
+from rate_limit import enforce
+from .groups import add_group_members, create_group, create_group_message, get_group_messages, get_groups, leave_group, mark_group_read
+from .service import CONVERSATION_PAGE_SIZE, MAX_CONVERSATION_PAGE_SIZE, MAX_MESSAGE_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE, MESSAGE_PAGE_SIZE, SEARCH_PAGE_SIZE, attach_message_media, create_message, dump_message_page, fail_message_media, get_conversation_version, get_conversations, get_messages, mark_read, search_messages
+
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
+# Read-only routes, served by a replica when DATABASE_REPLICA_URLS is set
+read_db_dependency = Annotated[AsyncSession, Depends(get_read_db)]
 user_dependency = Annotated[dict, Depends(get_current_user)]
 
 
@@ -20,14 +25,74 @@ router = APIRouter(
     tags=["Message"]
 )
 
-@router.get("/{receiver_id}/", status_code=status.HTTP_200_OK, response_model=List[MessageOut])
-async def get_all_messages(db : db_dependency, current_user : user_dependency, receiver_id : int = Path(ge=1)):
+inbox_router = APIRouter(
+    prefix="/conversations",
+    tags=["Conversation"]
+)
+
+group_router = APIRouter(
+    prefix="/groups",
+    tags=["Group"]
+)
+
+
+@inbox_router.get("", status_code=status.HTTP_200_OK, response_model=ConversationPage)
+async def get_inbox(db : read_db_dependency, current_user : user_dependency, cursor : Optional[str] = Query(None),
+                    limit : int = Query(CONVERSATION_PAGE_SIZE, ge=1, le=MAX_CONVERSATION_PAGE_SIZE)):
+    try:
+        return await get_conversations(db, current_user.id, cursor=cursor, limit=limit)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@inbox_router.post("/read", status_code=status.HTTP_200_OK, response_model=ReadState)
+async def mark_conversation_read(db : db_dependency, current_user : user_dependency, payload : MarkRead):
+    try:
+        return await mark_read(db, current_user.id, payload.peer_id, payload.message_id)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@router.get("/search", status_code=status.HTTP_200_OK, response_model=MessageSearchPage)
+async def search_all_messages(db : read_db_dependency, current_user : user_dependency, q : str = Query(min_length=1, max_length=200),
+                              peer_id : Optional[int] = Query(None, ge=1), cursor : Optional[str] = Query(None),
+                              limit : int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE)):
+    try:
+        page = await search_messages(db, current_user.id, q, peer_id=peer_id, cursor=cursor, limit=limit)
+        return Response(content=dump_message_page(page), media_type="application/json")
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@router.get("/{receiver_id}/", status_code=status.HTTP_200_OK, response_model=MessagePage)
+async def get_all_messages(db : read_db_dependency, current_user : user_dependency, request : Request, receiver_id : int = Path(ge=1),
+                           before : Optional[str] = Query(None), after : Optional[str] = Query(None),
+                           since : Optional[str] = Query(None, description="Message id or ISO timestamp, only newer messages"),
+                           limit : int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE)):
     try:
-        receiver = db.query(User).filter(User.id == receiver_id).first()
+        receiver = await get_user_by_id(db, receiver_id)
         if not receiver:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found")
-        messages = get_messages(db, current_user.id, receiver.id)
-        return messages
+        # Read before the page, so a message landing in between can only make the tag stale, never the body
+        etag = make_etag("messages", current_user.id, receiver_id, await get_conversation_version(db, current_user.id, receiver_id),
+                         query_key(before=before, after=after, since=since, limit=limit))
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        page = await get_messages(db, current_user.id, receiver.id, before=before, after=after, limit=limit, since=since)
+        # Serialized here rather than through response_model, which stays for the OpenAPI schema
+        return set_etag(Response(content=dump_message_page(page), media_type="application/json"), etag)
     except HTTPException as htp_err:
         raise htp_err
     except Exception as exp:
@@ -39,9 +104,10 @@ async def get_all_messages(db : db_dependency, current_user : user_dependency, r
 
 
 @router.post("/send/{receiver_id}", status_code=status.HTTP_201_CREATED)
-async def send_message(db : db_dependency, current_user : user_dependency, receiver_id : int = Path(ge=1), content: Optional[str] = Form(None),img_file: Optional[UploadFile] = File(None),):
+async def send_message(db : db_dependency, current_user : user_dependency, request : Request, receiver_id : int = Path(ge=1), content: Optional[str] = Form(None),img_file: Optional[UploadFile] = File(None),):
     try:
-        receiver = db.query(User).filter(User.id == receiver_id).first()
+        enforce("send_message", request, current_user.id)
+        receiver = await get_user_by_id(db, receiver_id)
         if not receiver:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User not found")
         if not content and not img_file:
@@ -49,11 +115,16 @@ async def send_message(db : db_dependency, current_user : user_dependency, recei
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Message must contain either text or an image"
             )
-        res = None
-        if img_file:
-            res = upload_file(img_file.file)
-
-        message = await create_message(db, current_user.id, receiver.id, content, res)
+        # The image is uploaded in the background, receivers get messageMediaReady once it is stored
+        spooled = await upload_pipeline.spool(img_file, owner=current_user.id) if img_file else None
+        try:
+            message = await create_message(db, current_user.id, receiver.id, content, None, media_pending=spooled is not None)
+        except Exception:
+            if spooled:
+                upload_pipeline.discard(spooled)
+            raise
+        if spooled:
+            upload_pipeline.submit(spooled, "messages", partial(attach_message_media, message.id), partial(fail_message_media, message.id))
         return message
     except HTTPException as htp_err:
         raise htp_err
@@ -61,4 +132,96 @@ async def send_message(db : db_dependency, current_user : user_dependency, recei
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=str(exp)
-        )
\ No newline at end of file
+        )
+
+
+@group_router.post("", status_code=status.HTTP_201_CREATED, response_model=GroupOut)
+async def new_group(db : db_dependency, current_user : user_dependency, payload : GroupCreate):
+    try:
+        return await create_group(db, current_user.id, payload.name, payload.member_ids)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.get("", status_code=status.HTTP_200_OK, response_model=GroupList)
+async def list_groups(db : read_db_dependency, current_user : user_dependency):
+    try:
+        return await get_groups(db, current_user.id)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.post("/{group_id}/members", status_code=status.HTTP_200_OK, response_model=GroupOut)
+async def add_members(db : db_dependency, current_user : user_dependency, payload : GroupMembersAdd, group_id : int = Path(ge=1)):
+    try:
+        return await add_group_members(db, group_id, current_user.id, payload.member_ids)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.delete("/{group_id}/members/me", status_code=status.HTTP_204_NO_CONTENT)
+async def leave(db : db_dependency, current_user : user_dependency, group_id : int = Path(ge=1)):
+    try:
+        await leave_group(db, group_id, current_user.id)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.get("/{group_id}/messages", status_code=status.HTTP_200_OK, response_model=MessagePage)
+async def get_group_history(db : read_db_dependency, current_user : user_dependency, group_id : int = Path(ge=1),
+                            before : Optional[str] = Query(None), after : Optional[str] = Query(None),
+                            since : Optional[str] = Query(None, description="Message id or ISO timestamp, only newer messages"),
+                            limit : int = Query(MESSAGE_PAGE_SIZE, ge=1, le=MAX_MESSAGE_PAGE_SIZE)):
+    try:
+        page = await get_group_messages(db, group_id, current_user.id, before=before, after=after, limit=limit, since=since)
+        return Response(content=dump_message_page(page), media_type="application/json")
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.post("/{group_id}/messages", status_code=status.HTTP_201_CREATED, response_model=MessageOut)
+async def send_group_message(db : db_dependency, current_user : user_dependency, request : Request, group_id : int = Path(ge=1), content : str = Form(min_length=1)):
+    try:
+        enforce("send_group_message", request, current_user.id)
+        if not content.strip():
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Message must contain text")
+        return await create_group_message(db, current_user.id, group_id, content)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
+
+@group_router.post("/{group_id}/read", status_code=status.HTTP_200_OK, response_model=GroupReadState)
+async def mark_group_messages_read(db : db_dependency, current_user : user_dependency, payload : GroupRead, group_id : int = Path(ge=1)):
+    try:
+        return await mark_group_read(db, group_id, current_user.id, payload.message_id)
+    except HTTPException as htp_err:
+        raise htp_err
+    except Exception as exp:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=str(exp)
+        )
@@ -1,14 +1,19 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
+from .enums import MediaStatus
+from auth.schemas import UserOut
 
 
 class MessageBase(BaseModel):
     sender_id: int
-    receiver_id: int
+    receiver_id: Optional[int]
+    group_id: Optional[int] = None
     content: Optional[str]
     image_url: Optional[str]
     image_id: Optional[str]
+    thumbnail_url: Optional[str] = None
+    media_status: Optional[MediaStatus] = None
     
 class MessageCreate(MessageBase):
     pass
@@ -19,4 +24,88 @@ class MessageOut(MessageBase):
     updated_at: datetime
 
     class Config:
-        from_attributes : True
\ No newline at end of file
+        from_attributes = True
+
+class MessageSend(BaseModel):
+    """Payload of the sendMessage socket event, client_id is echoed back in the ack"""
+    receiver_id: int = Field(ge=1)
+    content: str = Field(min_length=1)
+    client_id: Optional[str] = None
+
+class GroupMessageSend(BaseModel):
+    """Payload of the sendGroupMessage socket event"""
+    group_id: int = Field(ge=1)
+    content: str = Field(min_length=1)
+    client_id: Optional[str] = None
+
+class MessagePage(BaseModel):
+    messages: List[MessageOut]
+    before_cursor: Optional[str] = None
+    after_cursor: Optional[str] = None
+
+
+
+class MessageSearchPage(BaseModel):
+    messages: List[MessageOut]
+    next_cursor: Optional[str] = None
+
+
+class ConversationOut(BaseModel):
+    peer: UserOut
+    last_message: MessageOut
+    last_activity_at: datetime
+    unread_count: int
+    last_read_message_id: int = 0
+    peer_last_read_message_id: int = 0
+
+
+class MarkRead(BaseModel):
+    """Payload of the markRead socket event and of POST /conversations/read"""
+    peer_id: int = Field(ge=1)
+    message_id: int = Field(ge=1)
+
+
+class ReadState(BaseModel):
+    peer_id: int
+    last_read_message_id: int
+    unread_count: int
+
+
+class ConversationPage(BaseModel):
+    conversations: List[ConversationOut]
+    next_cursor: Optional[str] = None
+
+
+
+class GroupCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=100)
+    member_ids: List[int] = Field(default_factory=list)
+
+
+class GroupMembersAdd(BaseModel):
+    member_ids: List[int] = Field(min_length=1)
+
+
+class GroupRead(BaseModel):
+    message_id: int = Field(ge=1)
+
+
+class GroupOut(BaseModel):
+    id: int
+    name: str
+    created_by: int
+    last_message_id: Optional[int] = None
+    last_activity_at: datetime
+    member_count: int
+    last_read_message_id: int = 0
+    unread_count: int = 0
+
+
+class GroupList(BaseModel):
+    groups: List[GroupOut]
+
+
+class GroupReadState(BaseModel):
+    group_id: int
+    last_read_message_id: int
+    unread_count: int
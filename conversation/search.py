@@ -0,0 +1,121 @@
+"""
+Full-text index over message.content.
+
+SQLite: a contentless FTS5 table message_fts whose rowid is the message id. Besides the text it
+indexes a `participants` column ("u<sender> u<receiver>", "u<sender> g<group>" for a group message),
+so scoping a search to the caller and their groups is a few more posting lists to intersect instead
+of a filter over every match in the whole table.
+create_message writes to it in the same transaction as the message (index_messages).
+
+Postgres: generated search_vector and participants columns on message with one multicolumn GIN
+index over both. Postgres maintains them itself, index_messages has nothing to do. Group messages
+are matched on group_id, participants only holds their sender.
+
+Archived messages stay searchable: their FTS rows are untouched by the move, on Postgres
+message_archive gets the same columns and index and the query covers both tables.
+
+There are no migrations, create_search_index runs at startup and builds whatever is missing.
+"""
+import re
+from typing import List, Optional
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import engine
+from .models import Message
+
+# No stemming on either backend so both return the same matches
+FTS5_TOKENIZER = "unicode61 remove_diacritics 2"
+TS_CONFIG = "simple"
+# Both tiers of message, see conversation.archive
+SEARCH_TABLES = ("message", "message_archive")
+
+
+def search_terms(q: str) -> List[str]:
+    """Word tokens of a user query, the only thing ever interpolated into MATCH / tsquery syntax"""
+    return re.findall(r"\w+", q.lower())
+
+
+def participants(message: Message) -> str:
+    if message.group_id is not None:
+        return f"u{message.sender_id} g{message.group_id}"
+    return f"u{message.sender_id} u{message.receiver_id}"
+
+
+async def create_search_index():
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            for table in SEARCH_TABLES:
+                await conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                    f"GENERATED ALWAYS AS (to_tsvector('{TS_CONFIG}', coalesce(content, ''))) STORED"
+                ))
+                await conn.execute(text(
+                    f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS participants integer[] "
+                    "GENERATED ALWAYS AS (ARRAY[sender_id, receiver_id]) STORED"
+                ))
+                await conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_search ON {table} USING gin (search_vector, participants)"
+                ))
+            return
+
+        exists = (await conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+        ))).first()
+        if exists:
+            return
+        await conn.execute(text(
+            f"CREATE VIRTUAL TABLE message_fts USING fts5(content, participants, content='', tokenize='{FTS5_TOKENIZER}')"
+        ))
+        # participants only narrows the match, it must not move the score
+        await conn.execute(text("INSERT INTO message_fts(message_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)')"))
+        await conn.execute(text(
+            "INSERT INTO message_fts(rowid, content, participants) "
+            "SELECT id, content, 'u' || sender_id || CASE WHEN group_id IS NULL THEN ' u' || receiver_id ELSE ' g' || group_id END "
+            "FROM message WHERE content IS NOT NULL"
+        ))
+
+
+async def index_messages(db: AsyncSession, messages: List[Message]):
+    """Adds freshly inserted messages to the index, in the caller's transaction"""
+    if db.get_bind().dialect.name == "postgresql":
+        return
+    rows = [{"id": message.id, "content": message.content, "participants": participants(message)}
+            for message in messages if message.content]
+    if rows:
+        await db.execute(text("INSERT INTO message_fts(rowid, content, participants) VALUES (:id, :content, :participants)"), rows)
+
+
+def search_query(dialect: str, terms: List[str], user_id: int, peer_id: Optional[int], group_ids: List[int] = ()):
+    """
+    (SQL, params) selecting `id` of matching messages best match first, among the messages user_id
+    sent or received and, without peer_id, those of group_ids. Every term must match as a
+    whole word: a prefix term would merge the postings of every word it starts, across all users,
+    and cost would grow with total history instead of with the caller's own matches.
+    """
+    if dialect == "postgresql":
+        tsquery = " & ".join(terms)
+        members = [user_id] if peer_id is None else [user_id, peer_id]
+        scope = "participants @> CAST(:members AS integer[])"
+        if peer_id is None and group_ids:
+            scope = f"({scope} OR group_id = ANY(CAST(:groups AS integer[])))"
+        matches = " UNION ALL ".join(
+            f"SELECT id, ts_rank(search_vector, query) AS score FROM {table}, to_tsquery(:config, :tsquery) AS query "
+            f"WHERE search_vector @@ query AND {scope}"
+            for table in SEARCH_TABLES
+        )
+        return (
+            f"SELECT id FROM ({matches}) AS matches ORDER BY score DESC, id DESC LIMIT :limit OFFSET :offset",
+            {"config": TS_CONFIG, "tsquery": tsquery, "members": members, "groups": list(group_ids)}
+        )
+
+    phrases = " ".join(f'"{term}"' for term in terms)
+    if peer_id is not None:
+        match = f"content : ({phrases}) AND participants : u{user_id} AND participants : u{peer_id}"
+    else:
+        scope = " OR ".join([f"u{user_id}"] + [f"g{int(group_id)}" for group_id in group_ids])
+        match = f"content : ({phrases}) AND participants : ({scope})"
+    return (
+        "SELECT rowid AS id FROM message_fts WHERE message_fts MATCH :match "
+        "ORDER BY rank, rowid DESC LIMIT :limit OFFSET :offset",
+        {"match": match}
+    )
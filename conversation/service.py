@@ -1,50 +1,475 @@
-from .models import Message
+from .models import ArchivedMessage, ConversationSummary, GroupMember, Message
+from .archive import merge_tiers, reaches_archive
+from .enums import MediaStatus
+from .batcher import MESSAGE_WRITE_MODE, MessageBatcher
+from .search import index_messages, search_query, search_terms
 from fastapi import HTTPException
-from sqlalchemy.orm import Session
-from .models import Message
-from typing import Optional
-from sqlalchemy import or_, and_
-from chat_socket import send_new_message
+from starlette import status
+from sqlalchemy.ext.asyncio import AsyncSession
+from auth.models import User
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import or_, and_, bindparam, case, func, insert, literal, select, text, tuple_, union_all, update
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta, timezone
+import base64
+import orjson
+from database import SessionLocal, upsert_insert, utcnow
+from chat_socket import emit_to_user, send_new_message
+from media_pipeline import UPLOAD_STALE_AFTER, upload_pipeline
+from logs import get_logger
 
+log = get_logger("conversation")
 
-async def create_message(db: Session, sender_id: int, receiver_id: int, content: Optional[str], res: Optional[dict]):
+MESSAGE_PAGE_SIZE = 50
+MAX_MESSAGE_PAGE_SIZE = 200
+CONVERSATION_PAGE_SIZE = 30
+MAX_CONVERSATION_PAGE_SIZE = 100
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+# History is read as plain row tuples of these columns, in MessageOut's field order
+MESSAGE_COLUMNS = (Message.sender_id, Message.receiver_id, Message.group_id, Message.content, Message.image_url, Message.image_id,
+                   Message.thumbnail_url, Message.media_status, Message.id, Message.created_at, Message.updated_at)
+MESSAGE_FIELDS = tuple(column.key for column in MESSAGE_COLUMNS)
+# The same columns read from the cold tier, rows of both tiers have the same keys
+ARCHIVE_COLUMNS = tuple(getattr(ArchivedMessage, field) for field in MESSAGE_FIELDS)
+
+
+async def create_message(db: AsyncSession, sender_id: int, receiver_id: int, content: Optional[str], res: Optional[dict], media_pending: bool = False):
     message = Message(
         sender_id=sender_id,
         receiver_id=receiver_id,
         content=content,
         image_url=res.get("secure_url") if res else None,
-        image_id=res.get("public_id") if res else None
+        image_id=res.get("public_id") if res else None,
+        thumbnail_url=res.get("thumbnail_url") if res else None,
+        media_status=MediaStatus.Pending if media_pending else (MediaStatus.Ready if res else None)
     )
-    db.add(message)
-    db.commit()
-    db.refresh(message)
+    message = await persist_message(db, message)
     
-    # Convert message to dict for Socket.IO emission
-    message_data = {
+    # Send via Socket.IO, an offline receiver gets it from the backlog replay on its next connect
+    delivered = await send_new_message(receiver_id, message_payload(message))
+    log.debug("message created", message_id=message.id, receiver_id=receiver_id, delivered=delivered)
+    return message  # Return the actual message object, NOT a coroutine
+
+
+def message_payload(message) -> dict:
+    """newMessage / messageBacklog payload of a Message or a MESSAGE_COLUMNS row"""
+    return {
         "id": message.id,
         "sender_id": message.sender_id,
         "receiver_id": message.receiver_id,
+        "group_id": message.group_id,
         "content": message.content,
         "image_url": message.image_url,
         "image_id": message.image_id,
+        "thumbnail_url": message.thumbnail_url,
+        "media_status": message.media_status.value if message.media_status else None,
         "created_at": message.created_at.isoformat() if message.created_at else None
     }
-    
-    # Send via Socket.IO
-    success = await send_new_message(receiver_id, message_data)
-    
-    if success:
-        print({"status": "success", "message": "Message sent via Socket.IO"})
-    else:
-        print({"status": "offline", "message": "User is offline"})
-    
-    return message  # Return the actual message object, NOT a coroutine
 
-def get_messages(db : Session, sender_id, receiver_id):
-    messages = db.query(Message).filter(
-        or_(
-            and_(Message.sender_id == sender_id, Message.receiver_id == receiver_id),
-            and_(Message.sender_id == receiver_id, Message.receiver_id == sender_id)
-        )
-    ).order_by(Message.created_at.asc()).all()
-    return messages
\ No newline at end of file
+
+async def persist_message(db: AsyncSession, message: Message) -> Message:
+    """Writes a new message and its inbox rows, grouped with concurrent sends when batching is on"""
+    if message_batcher is not None:
+        return await message_batcher.submit(message)
+    db.add(message)
+    await db.flush()
+    await after_messages_inserted(db, [message])
+    await db.commit()
+    await db.refresh(message)
+    return message
+
+
+async def after_messages_inserted(db: AsyncSession, messages: List[Message]):
+    """Everything derived from new messages that must commit together with them"""
+    await update_conversation_summaries(db, messages)
+    await index_messages(db, messages)
+
+
+async def update_conversation_summaries(db: AsyncSession, messages: List[Message]):
+    """Moves the (sender, receiver) and (receiver, sender) inbox rows to each message, in the caller's transaction"""
+    rows = []
+    for message in messages:
+        rows.append({"user_id": message.sender_id, "peer_id": message.receiver_id, "last_message_id": message.id,
+                     "last_activity_at": message.created_at, "unread_count": 0, "version": 1})
+        if message.receiver_id != message.sender_id:
+            rows.append({"user_id": message.receiver_id, "peer_id": message.sender_id, "last_message_id": message.id,
+                         "last_activity_at": message.created_at, "unread_count": 1, "version": 1})
+
+    stmt = upsert_insert(db)(ConversationSummary)
+    # A commit that lands late must not replace a newer last message
+    is_newer = stmt.excluded.last_message_id > ConversationSummary.last_message_id
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ConversationSummary.user_id, ConversationSummary.peer_id],
+        set_={
+            "last_message_id": case((is_newer, stmt.excluded.last_message_id), else_=ConversationSummary.last_message_id),
+            "last_activity_at": case((is_newer, stmt.excluded.last_activity_at), else_=ConversationSummary.last_activity_at),
+            "unread_count": ConversationSummary.unread_count + stmt.excluded.unread_count,
+            "version": ConversationSummary.version + 1
+        }
+    )
+    await db.execute(stmt, rows)
+
+
+async def bump_conversation_version(db: AsyncSession, user_id: int, peer_id: int):
+    """Invalidates the history ETags of both sides after an existing message changed, in the caller's transaction"""
+    await db.execute(
+        update(ConversationSummary)
+        .where(or_(
+            and_(ConversationSummary.user_id == user_id, ConversationSummary.peer_id == peer_id),
+            and_(ConversationSummary.user_id == peer_id, ConversationSummary.peer_id == user_id)
+        ))
+        .values(version=ConversationSummary.version + 1)
+    )
+
+
+async def get_conversation_version(db: AsyncSession, user_id: int, peer_id: int) -> int:
+    """Primary key lookup, 0 until the pair exchanged a message"""
+    version = await db.scalar(select(ConversationSummary.version).where(
+        ConversationSummary.user_id == user_id, ConversationSummary.peer_id == peer_id
+    ))
+    return version or 0
+
+
+async def apply_read_marks(db: AsyncSession, marks: Dict[Tuple[int, int], int]) -> List[Tuple[int, int, int]]:
+    """
+    Moves read watermarks forward, marks maps (user_id, peer_id) to the newest message id the user has
+    seen. Ids outside the conversation and marks behind the current watermark are dropped. Every
+    remaining conversation is one UPDATE of its summary row, in the caller's transaction, and its
+    unread_count is recounted from the ix_message_conversation range after the watermark, which only
+    touches the messages that are still unread. Returns the (user_id, peer_id, message_id) that advanced.
+    """
+    if not marks:
+        return []
+    pairs = (await db.execute(
+        select(Message.id, Message.sender_id, Message.receiver_id).where(Message.id.in_(set(marks.values())))
+    )).all()
+    pairs = {id: {sender_id, receiver_id} for id, sender_id, receiver_id in pairs}
+    current = dict((((user_id, peer_id), last_read) for user_id, peer_id, last_read in (await db.execute(
+        select(ConversationSummary.user_id, ConversationSummary.peer_id, ConversationSummary.last_read_message_id)
+        .where(tuple_(ConversationSummary.user_id, ConversationSummary.peer_id).in_(list(marks)))
+    )).all()))
+    advanced = [(user_id, peer_id, message_id) for (user_id, peer_id), message_id in marks.items()
+                if pairs.get(message_id) == {user_id, peer_id} and (user_id, peer_id) in current
+                and message_id > current[(user_id, peer_id)]]
+    if not advanced:
+        return []
+
+    watermark = aliased(Message)
+    unread = select(func.count()).select_from(Message) \
+        .join(watermark, watermark.id == bindparam("b_message_id")) \
+        .where(
+            Message.sender_id == bindparam("b_peer_id"),
+            Message.receiver_id == bindparam("b_user_id"),
+            tuple_(Message.created_at, Message.id) > tuple_(watermark.created_at, watermark.id)
+        ).scalar_subquery()
+    summary = ConversationSummary.__table__
+    # Guarded again, another process may have moved the watermark since the read above
+    await db.execute(
+        update(summary)
+        .where(summary.c.user_id == bindparam("b_user_id"), summary.c.peer_id == bindparam("b_peer_id"),
+               summary.c.last_read_message_id < bindparam("b_message_id"))
+        .values(last_read_message_id=bindparam("b_message_id"), unread_count=unread),
+        [{"b_user_id": user_id, "b_peer_id": peer_id, "b_message_id": message_id} for user_id, peer_id, message_id in advanced]
+    )
+    return advanced
+
+
+async def notify_messages_read(advanced: List[Tuple[int, int, int]]):
+    """messagesRead to the sender side of every conversation whose watermark moved"""
+    for user_id, peer_id, message_id in advanced:
+        await emit_to_user(peer_id, "messagesRead", {"reader_id": user_id, "last_read_message_id": message_id})
+
+
+async def mark_read(db: AsyncSession, user_id: int, peer_id: int, message_id: int) -> dict:
+    """Uncoalesced mark for the REST route, returns the read state after it"""
+    advanced = await apply_read_marks(db, {(user_id, peer_id): message_id})
+    await db.commit()
+    await notify_messages_read(advanced)
+    summary = await db.get(ConversationSummary, (user_id, peer_id), populate_existing=True)
+    if summary is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Conversation not found")
+    return {"peer_id": peer_id, "last_read_message_id": summary.last_read_message_id, "unread_count": summary.unread_count}
+
+
+message_batcher = MessageBatcher(SessionLocal, after_messages_inserted) if MESSAGE_WRITE_MODE == "batched" else None
+
+
+async def backfill_conversation_summaries():
+    """Builds the inbox rows from existing history the first time the table is empty"""
+    async with SessionLocal() as db:
+        if (await db.execute(select(ConversationSummary.user_id).limit(1))).first():
+            return
+        directed = union_all(
+            select(Message.sender_id.label("user_id"), Message.receiver_id.label("peer_id"), Message.id.label("message_id"))
+            .where(Message.receiver_id.isnot(None)),
+            select(Message.receiver_id, Message.sender_id, Message.id)
+            .where(Message.receiver_id.isnot(None))
+        ).subquery()
+        latest = select(
+            directed.c.user_id,
+            directed.c.peer_id,
+            func.max(directed.c.message_id).label("last_message_id")
+        ).group_by(directed.c.user_id, directed.c.peer_id).subquery()
+        # History from before the inbox counts as read, like it counts as delivered (Message.delivered_at)
+        rows = select(latest.c.user_id, latest.c.peer_id, latest.c.last_message_id, Message.created_at, literal(0),
+                      latest.c.last_message_id) \
+            .join(Message, Message.id == latest.c.last_message_id)
+        await db.execute(insert(ConversationSummary).from_select(
+            ["user_id", "peer_id", "last_message_id", "last_activity_at", "unread_count", "last_read_message_id"], rows
+        ))
+        await db.commit()
+
+
+async def get_conversations(db: AsyncSession, user_id: int, cursor: Optional[str] = None, limit: int = CONVERSATION_PAGE_SIZE):
+    """Inbox page, most recently active conversation first"""
+    limit = max(1, min(limit, MAX_CONVERSATION_PAGE_SIZE))
+    # The peer's own row holds how far they have read, primary key lookup per conversation
+    peer_summary = aliased(ConversationSummary)
+    query = select(ConversationSummary, Message, User, peer_summary.last_read_message_id) \
+        .join(Message, Message.id == ConversationSummary.last_message_id) \
+        .join(User, User.id == ConversationSummary.peer_id) \
+        .outerjoin(peer_summary, and_(peer_summary.user_id == ConversationSummary.peer_id,
+                                      peer_summary.peer_id == ConversationSummary.user_id)) \
+        .where(ConversationSummary.user_id == user_id)
+    if cursor:
+        last_activity_at, peer_id = decode_cursor(cursor)
+        query = query.where(or_(
+            ConversationSummary.last_activity_at < last_activity_at,
+            and_(ConversationSummary.last_activity_at == last_activity_at, ConversationSummary.peer_id < peer_id)
+        ))
+    query = query.order_by(ConversationSummary.last_activity_at.desc(), ConversationSummary.peer_id.desc()).limit(limit + 1)
+
+    rows = (await db.execute(query)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    conversations = [
+        {
+            "peer": peer,
+            "last_message": message,
+            "last_activity_at": summary.last_activity_at,
+            "unread_count": summary.unread_count,
+            "last_read_message_id": summary.last_read_message_id,
+            "peer_last_read_message_id": peer_last_read or 0
+        }
+        for summary, message, peer, peer_last_read in rows
+    ]
+    next_cursor = None
+    if has_more:
+        summary = rows[-1][0]
+        next_cursor = encode_keyset(summary.last_activity_at, summary.peer_id)
+    return {"conversations": conversations, "next_cursor": next_cursor}
+
+
+async def _finish_message_media(message_id: int, media_status: MediaStatus, res: Optional[dict]):
+    async with SessionLocal() as db:
+        message = await db.get(Message, message_id)
+        if not message:
+            if res:
+                await upload_pipeline.media.release(res["public_id"])
+            return None
+        message.media_status = media_status
+        if res:
+            message.image_url = res.get("secure_url")
+            message.image_id = res.get("public_id")
+            message.thumbnail_url = res.get("thumbnail_url")
+        elif media_status == MediaStatus.Failed:
+            # The pipeline released whatever was stored
+            message.image_url = message.image_id = message.thumbnail_url = None
+        await bump_conversation_version(db, message.sender_id, message.receiver_id)
+        await db.commit()
+
+    media_data = {
+        "id": message.id,
+        "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id,
+        "image_url": message.image_url,
+        "image_id": message.image_id,
+        "thumbnail_url": message.thumbnail_url,
+        "media_status": media_status.value
+    }
+    event = "messageMediaReady" if media_status == MediaStatus.Ready else "messageMediaFailed"
+    await emit_to_user(message.receiver_id, event, media_data)
+    await emit_to_user(message.sender_id, event, media_data)
+    return message
+
+
+async def attach_message_media(message_id: int, res: dict):
+    """Upload pipeline callback: the image of a pending message is stored"""
+    await _finish_message_media(message_id, MediaStatus.Ready, res)
+
+
+async def fail_message_media(message_id: int, exp: Exception):
+    await _finish_message_media(message_id, MediaStatus.Failed, None)
+
+
+async def fail_stale_media(stale_after: float = UPLOAD_STALE_AFTER) -> int:
+    """
+    Startup: images still pending long after they were sent lost their upload with the process that
+    queued it, they fail like any other upload. Younger ones may belong to another running process.
+    """
+    cutoff = utcnow() - timedelta(seconds=stale_after)
+    async with SessionLocal() as db:
+        ids = (await db.scalars(
+            select(Message.id).where(Message.media_status == MediaStatus.Pending, Message.created_at < cutoff)
+        )).all()
+    for message_id in ids:
+        await _finish_message_media(message_id, MediaStatus.Failed, None)
+    return len(ids)
+
+def encode_cursor(message: Message) -> str:
+    """Opaque keyset cursor for a message's (created_at, id) position"""
+    return encode_keyset(message.created_at, message.id)
+
+
+def encode_keyset(timestamp: datetime, id: int) -> str:
+    raw = f"{timestamp.isoformat()}|{id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.rsplit("|", 1)
+        created_at = datetime.fromisoformat(created_at)
+        if created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
+        return created_at, int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+async def decode_since(db: AsyncSession, since: str):
+    """Keyset position for `since`: just after a message id, or at an ISO timestamp"""
+    if since.isdigit():
+        row = (await db.execute(select(Message.created_at, Message.id).where(Message.id == int(since)))).first()
+        if not row:
+            row = (await db.execute(
+                select(ArchivedMessage.created_at, ArchivedMessage.id).where(ArchivedMessage.id == int(since))
+            )).first()
+        if not row:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown message id in since")
+        return row.created_at, row.id
+    try:
+        timestamp = datetime.fromisoformat(since)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="since must be a message id or an ISO timestamp")
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp, 0
+
+
+async def get_messages(db : AsyncSession, sender_id, receiver_id, before: Optional[str] = None, after: Optional[str] = None,
+                       limit: int = MESSAGE_PAGE_SIZE, since: Optional[str] = None):
+    """
+    Returns one page of a conversation in chronological order, messages are MESSAGE_COLUMNS rows.
+    Without a cursor the latest page is returned, `before` walks back in history and `after` walks forward.
+    `since` also walks forward, from a message id or from an ISO timestamp (messages at or after it).
+    Pages reaching past the hot window also read message_archive, see conversation.archive.
+    """
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE_SIZE))
+    keyset, forward = await resolve_keyset(db, before, after, since)
+
+    def conversation_page(model, columns):
+        def one_direction(from_id, to_id):
+            # Each direction walks the conversation index in order and stops after limit + 1 rows,
+            # an OR over both directions would sort everything before the cursor on every page
+            query = select(*columns).where(model.sender_id == from_id, model.receiver_id == to_id)
+            # Row values keep the cursor an index range, the equivalent OR is only filtered with bound parameters
+            position = tuple_(model.created_at, model.id)
+            if forward:
+                return query.where(position > keyset).order_by(model.created_at.asc(), model.id.asc()).limit(limit + 1)
+            if before:
+                query = query.where(position < keyset)
+            return query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)
+
+        directions = [one_direction(sender_id, receiver_id)]
+        if receiver_id != sender_id:
+            directions.append(one_direction(receiver_id, sender_id))
+        merged = union_all(*(select(direction.subquery()) for direction in directions)).subquery()
+        order = (merged.c.created_at.asc(), merged.c.id.asc()) if forward else (merged.c.created_at.desc(), merged.c.id.desc())
+        # One extra row tells us whether another page exists in the direction of travel
+        return select(merged).order_by(*order).limit(limit + 1)
+
+    rows = (await db.execute(conversation_page(Message, MESSAGE_COLUMNS))).all()
+    if reaches_archive(rows, keyset, forward, limit):
+        cold = (await db.execute(conversation_page(ArchivedMessage, ARCHIVE_COLUMNS))).all()
+        rows = merge_tiers(rows, cold, forward, limit)
+    return message_page(rows, limit, forward, bool(before))
+
+
+async def resolve_keyset(db: AsyncSession, before: Optional[str], after: Optional[str], since: Optional[str]):
+    """(keyset, forward) of a history request, keyset is None for the latest page"""
+    if sum(1 for cursor in (before, after, since) if cursor) > 1:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use only one of before, after or since")
+    forward = bool(after or since)
+    if since:
+        return await decode_since(db, since), forward
+    return (decode_cursor(after or before) if (after or before) else None), forward
+
+
+def message_page(messages: list, limit: int, forward: bool, before: bool) -> dict:
+    """Page dict from up to limit + 1 rows fetched in the direction of travel"""
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not forward:
+        messages.reverse()
+
+    older = has_more if not forward else True
+    newer = has_more if forward else before
+    return {
+        "messages": messages,
+        "before_cursor": encode_cursor(messages[0]) if messages and older else None,
+        "after_cursor": encode_cursor(messages[-1]) if messages and newer else None,
+    }
+
+
+def dump_message_page(page: dict) -> bytes:
+    """Page JSON straight from MESSAGE_COLUMNS rows, without ORM objects or per-row validation"""
+    return orjson.dumps({**page, "messages": [dict(zip(MESSAGE_FIELDS, row)) for row in page["messages"]]})
+
+
+async def search_messages(db: AsyncSession, user_id: int, q: str, peer_id: Optional[int] = None,
+                          cursor: Optional[str] = None, limit: int = SEARCH_PAGE_SIZE):
+    """
+    Ranked full-text search over the messages user_id sent or received and those of their groups,
+    optionally only the conversation with peer_id.
+    Pages are offsets into the ranking, `cursor` is the opaque next_cursor of the previous page.
+    """
+    terms = search_terms(q)
+    if not terms:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Search query has no words")
+    limit = max(1, min(limit, MAX_SEARCH_PAGE_SIZE))
+    offset = decode_offset(cursor) if cursor else 0
+
+    group_ids = [] if peer_id is not None else \
+        (await db.scalars(select(GroupMember.group_id).where(GroupMember.user_id == user_id))).all()
+    sql, params = search_query(db.get_bind().dialect.name, terms, user_id, peer_id, group_ids)
+    result = await db.execute(text(sql), {**params, "limit": limit + 1, "offset": offset})
+    ids = [row.id for row in result]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+
+    rows = {row.id: row for row in await db.execute(select(*MESSAGE_COLUMNS).where(Message.id.in_(ids)))} if ids else {}
+    archived = [id for id in ids if id not in rows]
+    if archived:
+        rows.update((row.id, row) for row in await db.execute(select(*ARCHIVE_COLUMNS).where(ArchivedMessage.id.in_(archived))))
+    return {
+        "messages": [rows[id] for id in ids if id in rows],
+        "next_cursor": encode_offset(offset + limit) if has_more else None,
+    }
+
+
+def encode_offset(offset: int) -> str:
+    return base64.urlsafe_b64encode(f"offset|{offset}".encode()).decode().rstrip("=")
+
+
+def decode_offset(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        kind, offset = raw.split("|", 1)
+        if kind != "offset" or int(offset) < 0:
+            raise ValueError(cursor)
+        return int(offset)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
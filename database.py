@@ -1,8 +1,17 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from datetime import datetime, timezone
+from random import choice
+from time import perf_counter
+from sqlalchemy import event, exc, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.elements import TextClause
 import os
 from dotenv import load_dotenv
+from metrics import Counter, Gauge, Histogram
 
 load_dotenv()
 URL = os.getenv("DATABASE_URL")
@@ -10,13 +19,208 @@ URL = os.getenv("DATABASE_URL")
 if not URL:
     raise ValueError("DATABASE_URL is not set in .env")
 
-engine = create_engine(URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Sync drivers in DATABASE_URL are swapped for their asyncio counterparts
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+# Connections kept open per engine, and how many more a burst may open on top
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds a request waits for a free connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Server connections are replaced after this many seconds, ahead of server or proxy idle timeouts
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# Applied to every new SQLite connection. WAL lets readers run while a write is in progress,
+# synchronous=NORMAL is durable under WAL except for the last transactions on power loss
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+# Comma separated, read-only routes go to one of these, see ReadSessionLocal
+REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+pool_wait = Histogram("db_pool_checkout_wait_seconds", "Time to get a connection from the pool, connecting included")
+pool_timeouts = Counter("db_pool_checkout_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT")
+
+
+def to_async_url(url: str):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}, set ASYNC_DATABASE_URL")
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+def timed_pool(role: str):
+    """Queue pool recording how long each checkout waited, labelled with the engine's role"""
+
+    class TimedQueuePool(AsyncAdaptedQueuePool):
+        def _do_get(self):
+            started = perf_counter()
+            try:
+                return super()._do_get()
+            except exc.TimeoutError:
+                pool_timeouts.inc(pool=role)
+                raise
+            finally:
+                pool_wait.observe(perf_counter() - started, pool=role)
+
+    return TimedQueuePool
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def make_engine(url, role: str):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    options = {}
+    if backend == "sqlite" and url.database in (None, "", ":memory:"):
+        # In-memory databases live in a single connection, nothing to size
+        pass
+    else:
+        options.update(poolclass=timed_pool(role), pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT)
+    if backend != "sqlite":
+        # A connection the server dropped while idle is replaced instead of failing the request
+        options.update(pool_pre_ping=True, pool_recycle=DB_POOL_RECYCLE)
+    async_engine = create_async_engine(url, **options)
+    if backend == "sqlite":
+        event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return async_engine
+
+
+ASYNC_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(URL)
+
+engine = make_engine(ASYNC_URL, "primary")
+replica_engines = [make_engine(to_async_url(url), f"replica{index}") for index, url in enumerate(REPLICA_URLS)]
+checked_out = Gauge("db_pool_checked_out", "Connections of the primary pool in use",
+                    lambda: engine.pool.checkedout() if hasattr(engine.pool, "checkedout") else 0)
+
+
+def is_read(clause) -> bool:
+    if isinstance(clause, Select):
+        return True
+    # Raw SQL is only trusted as a read when it is a plain SELECT
+    return isinstance(clause, TextClause) and clause.text.lstrip()[:6].upper() == "SELECT"
+
+
+class RoutingSession(Session):
+    """
+    Reads go to a replica picked once per session. The first statement that writes goes to the
+    primary, and so does everything after it, so the session reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or (clause is not None and not is_read(clause)):
+            self.info["primary"] = True
+        if self.info.get("primary"):
+            return engine.sync_engine
+        if "replica" not in self.info:
+            self.info["replica"] = choice(replica_engines).sync_engine
+        return self.info["replica"]
+
+
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+if replica_engines:
+    ReadSessionLocal = async_sessionmaker(class_=AsyncSession, sync_session_class=RoutingSession,
+                                          autoflush=False, expire_on_commit=False)
+else:
+    ReadSessionLocal = SessionLocal
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
+
+
+if replica_engines:
+    async def get_read_db():
+        """Session for read-only routes, may lag the primary by the replication delay"""
+        async with ReadSessionLocal() as db:
+            yield db
+else:
+    # The same dependency, so a route and get_current_user keep sharing one session
+    get_read_db = get_db
+
+
+def utcnow() -> datetime:
+    """Naive UTC, what the DateTime (without time zone) columns store; asyncpg refuses aware values"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def upsert_insert(db):
+    """INSERT construct with on_conflict_do_update for the session's backend"""
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def column_ddl(column, dialect) -> str:
+    """
+    Definition for ALTER TABLE ADD COLUMN. NOT NULL only when a scalar default fills the existing
+    rows, other required columns are added nullable and filled by their backfill.
+    """
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default
+    if default is not None and default.is_scalar:
+        literal = column.type.literal_processor(dialect) or repr
+        ddl += f" DEFAULT {literal(default.arg)}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    for foreign_key in column.foreign_keys:
+        ddl += f" REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})"
+    return ddl
+
+
+def add_missing_columns(conn) -> set:
+    """
+    create_all skips tables that exist, so columns and indexes added to a model later are added
+    here, and indexes named in a table's info["retired_indexes"] are dropped. A column's
+    info["backfill"] is the SQL expression existing rows get. Returns the "table.column" names added.
+    """
+    inspector = inspect(conn)
+    existing_tables = set(inspector.get_table_names())
+    added = set()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # Postgres enums are types of their own
+            if hasattr(column.type, "create"):
+                column.type.create(conn, checkfirst=True)
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl(column, conn.dialect)}"))
+            if "backfill" in column.info:
+                conn.execute(text(f"UPDATE {table.name} SET {column.name} = {column.info['backfill']}"))
+            added.add(f"{table.name}.{column.name}")
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+        for name in table.info.get("retired_indexes", ()):
+            conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    return added
+
+
+async def create_tables() -> set:
+    """Creates missing tables and adds missing columns and indexes, see add_missing_columns"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        return await conn.run_sync(add_missing_columns)
+
+
+async def dispose_engines():
+    await engine.dispose()
+    for replica in replica_engines:
+        await replica.dispose()
@@ -0,0 +1,43 @@
+"""
+Strong ETags built from version counters the handler can read with one indexed lookup, so a
+conditional GET is answered with 304 before the response body is ever queried or serialized.
+"""
+import hashlib
+from fastapi import Request, Response
+from starlette import status
+
+# Clients may keep the body but must revalidate it before every use
+CACHE_CONTROL = "private, no-cache"
+
+
+def make_etag(*parts) -> str:
+    return '"' + "-".join(str(part) for part in parts) + '"'
+
+
+def query_key(**params) -> str:
+    """
+    Short digest of a handler's validated query parameters, part of the tag so every page and
+    filter of a resource revalidates on its own. None values are left out, like absent parameters.
+    """
+    normalized = "&".join(f"{name}={value}" for name, value in sorted(params.items()) if value is not None)
+    return hashlib.sha256(normalized.encode()).hexdigest()[:16]
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match uses the weak comparison, a W/ prefix on the client's tag does not matter"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+
+def set_etag(response: Response, etag: str) -> Response:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
@@ -0,0 +1,89 @@
+"""
+Request and database instrumentation, exposed through /metrics.
+
+RequestMetricsMiddleware times every HTTP request under its route template (never the raw path,
+so ids do not explode the label set) and counts the SQL statements it ran. Statements are seen
+through SQLAlchemy's cursor events, which run on the request's own context, so the per-request
+totals need no plumbing through the services.
+"""
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Optional
+from sqlalchemy import event
+from database import engine, replica_engines
+from metrics import Histogram
+
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+request_duration = Histogram("http_request_duration_seconds", "HTTP request latency by route template")
+request_queries = Histogram("http_request_db_queries", "SQL statements run per HTTP request", QUERY_COUNT_BUCKETS)
+request_db_time = Histogram("http_request_db_seconds", "Time spent in SQL per HTTP request", QUERY_BUCKETS)
+query_duration = Histogram("db_query_duration_seconds", "Time per SQL statement", QUERY_BUCKETS)
+
+
+class QueryStats:
+    __slots__ = ("count", "seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Statements run while a request is being handled add up here
+current_queries: ContextVar[Optional[QueryStats]] = ContextVar("current_queries", default=None)
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = perf_counter()
+
+
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = perf_counter() - context._query_started
+    query_duration.observe(elapsed)
+    stats = current_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+
+
+# Replicas too, reads RoutingSession sends there count toward the request like any other statement
+for instrumented in (engine, *replica_engines):
+    event.listen(instrumented.sync_engine, "before_cursor_execute", _start_query)
+    event.listen(instrumented.sync_engine, "after_cursor_execute", _finish_query)
+
+
+def route_template(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """Pure ASGI, so streaming responses and the Socket.IO mount are not buffered"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = QueryStats()
+        token = current_queries.set(stats)
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_queries.reset(token)
+            route = route_template(scope)
+            request_duration.observe(perf_counter() - started, method=scope["method"], route=route, status=status_code)
+            request_queries.observe(stats.count, route=route)
+            request_db_time.observe(stats.seconds, route=route)
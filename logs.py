@@ -0,0 +1,101 @@
+"""
+Structured logging for the app's own modules.
+
+Records are JSON lines ({"ts", "level", "logger", "msg", ...fields}) written by a listener thread:
+the event loop only enqueues them. Calls below LOG_LEVEL return after one cached level check and
+never build a record, so per-message and per-socket logging on the hot paths stays at DEBUG.
+
+    log = get_logger("chat_socket")
+    log.debug("emit", event=event, user_id=user_id)
+"""
+import logging
+import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import orjson
+from dotenv import load_dotenv
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_queue = queue.SimpleQueue()
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 6), "level": record.levelname.lower(), "logger": record.name,
+                 "msg": record.getMessage()}
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class BufferedHandler(QueueHandler):
+    """Enqueues the record as is, formatting happens on the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class StructuredLogger:
+    """Logger whose keyword arguments become fields of the JSON line"""
+    __slots__ = ("_logger",)
+
+    def __init__(self, logger: logging.Logger):
+        self._logger = logger
+
+    def _log(self, level: int, msg: str, fields: dict, exc_info=None):
+        if self._logger.isEnabledFor(level):
+            self._logger.log(level, msg, exc_info=exc_info, extra={"fields": fields})
+
+    def is_enabled(self, level: int) -> bool:
+        return self._logger.isEnabledFor(level)
+
+    def debug(self, msg: str, **fields):
+        self._log(logging.DEBUG, msg, fields)
+
+    def info(self, msg: str, **fields):
+        self._log(logging.INFO, msg, fields)
+
+    def warning(self, msg: str, **fields):
+        self._log(logging.WARNING, msg, fields)
+
+    def error(self, msg: str, **fields):
+        self._log(logging.ERROR, msg, fields)
+
+    def exception(self, msg: str, **fields):
+        """ERROR with the traceback of the exception being handled"""
+        self._log(logging.ERROR, msg, fields, exc_info=True)
+
+
+def _configure():
+    global _listener
+    if _listener is not None:
+        return
+    root = logging.getLogger("chat")
+    root.setLevel(LOG_LEVEL)
+    root.propagate = False
+    root.addHandler(BufferedHandler(_queue))
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = QueueListener(_queue, output)
+    _listener.start()
+
+
+def get_logger(name: str) -> StructuredLogger:
+    _configure()
+    return StructuredLogger(logging.getLogger(f"chat.{name}"))
+
+
+def shutdown_logging():
+    """Writes out whatever is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        logging.getLogger("chat").handlers.clear()
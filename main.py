@@ -1,19 +1,60 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.staticfiles import StaticFiles
+import os
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from database import Base, engine
+from database import create_tables, dispose_engines
 from auth.routes import router as a_router
-from conversation.routes import router as c_router
-from chat_socket import sio   # <-- import socketio server
+from conversation.routes import group_router, inbox_router, router as c_router
+from conversation.service import backfill_conversation_summaries, fail_stale_media, message_batcher
+from conversation.search import create_search_index
+import conversation.events  # registers the sendMessage and sendGroupMessage socket events
+import conversation.delivery  # registers the backlog replay and ackMessages
+from conversation.receipts import read_receipts  # registers markRead
+from conversation.archive import message_archiver
+from auth.service import backfill_normalized_names, password_hasher
+from cloudinary_srv import MEDIA_BACKEND, MEDIA_ROOT, MEDIA_URL
+from media_pipeline import upload_pipeline
+from chat_socket import sio, start_socket_backend, stop_socket_backend   # <-- import socketio server
 import socketio
+import metrics
+from instrumentation import RequestMetricsMiddleware
+from logs import shutdown_logging
 
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables
+    await create_tables()
+    await backfill_normalized_names()
+    await create_search_index()
+    await backfill_conversation_summaries()
+    # Uploads lost with a previous process: their messages fail, their spool files go
+    await fail_stale_media()
+    upload_pipeline.clean_spool()
+    await start_socket_backend()
+    message_archiver.start()
+    yield
+    await message_archiver.close()
+    if message_batcher is not None:
+        await message_batcher.close()
+    await read_receipts.close()
+    # Before the socket backend stops, failed uploads still notify their conversations
+    await upload_pipeline.shutdown()
+    await stop_socket_backend()
+    password_hasher.shutdown()
+    await dispose_engines()
+    shutdown_logging()
+
 # --- FastAPI setup ---
 app = FastAPI(
     title="Chat Application",
     description="Chat Application with Images sending functionality",
-    version="0.1"
+    version="0.1",
+    lifespan=lifespan
 )
 
 # CORS middleware for REST API
@@ -25,17 +66,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+# Route latency and SQL statements per request, see /metrics
+app.add_middleware(RequestMetricsMiddleware)
+
+# Serve uploads ourselves when the local storage stand-in is used
+if MEDIA_BACKEND == "local":
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    app.mount(MEDIA_URL, StaticFiles(directory=MEDIA_ROOT), name="media")
 
 # Include routers
 app.include_router(a_router)
 app.include_router(c_router)
+app.include_router(inbox_router)
+app.include_router(group_router)
 
 @app.get("/")
 async def get_root():
     return {"detail": "Working Fine"}
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # --- Combine FastAPI app with Socket.IO ---
 socket_app = socketio.ASGIApp(sio, other_asgi_app=app)
 
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, Optional
+from fastapi import HTTPException, UploadFile
+from starlette import status
+from cloudinary_srv import MediaStorage, UPLOAD_CHUNK_SIZE, storage
+from database import SessionLocal
+from media_store import MediaStore
+from logs import get_logger
+from metrics import Counter, Gauge, Histogram
+from dotenv import load_dotenv
+load_dotenv()
+
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+UPLOAD_QUEUE_DEPTH = int(os.getenv("UPLOAD_QUEUE_DEPTH", "64"))
+# Uploads one user may have spooling, queued or uploading at once, so a single client cannot fill the queue
+UPLOAD_MAX_PER_USER = int(os.getenv("UPLOAD_MAX_PER_USER", "3"))
+UPLOAD_SPOOL_DIR = os.getenv("UPLOAD_SPOOL_DIR") or None
+# Seconds shutdown waits for queued uploads before failing them
+UPLOAD_SHUTDOWN_GRACE = float(os.getenv("UPLOAD_SHUTDOWN_GRACE", "10"))
+# An upload not finished after this many seconds was lost with its process, see clean_spool
+UPLOAD_STALE_AFTER = float(os.getenv("UPLOAD_STALE_AFTER", "600"))
+SPOOL_PREFIX = "chat-upload-"
+
+upload_duration = Histogram("media_upload_duration_seconds", "Time spent uploading one file to media storage",
+                            (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+upload_spool_duration = Histogram("media_upload_spool_seconds", "Time spent streaming and hashing a request file to disk")
+upload_queue_wait = Histogram("media_upload_queue_wait_seconds", "Time an upload waited for a worker")
+upload_failures = Counter("media_upload_failures_total", "Uploads that raised")
+upload_rejected = Counter("media_upload_rejected_total", "Uploads rejected because the queue or the user's share of it was full")
+upload_pending = Gauge("media_upload_pending", "Uploads accepted and not yet finished")
+log = get_logger("media_pipeline")
+
+
+class SpooledUpload(str):
+    """Path of a spooled upload carrying the SHA-256 and size of its content and who sent it"""
+
+    def __new__(cls, path: str, sha256: str, size: int, owner=None):
+        spooled = super().__new__(cls, path)
+        spooled.sha256 = sha256
+        spooled.size = size
+        spooled.owner = owner
+        return spooled
+
+
+def copy_hashed(source, destination):
+    """copyfileobj that hashes the chunks on the way through, returns (sha256 hex, size)"""
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+        digest.update(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class UploadPipeline:
+    """
+    Uploads media in the background: the request only spools the file to disk,
+    a bounded set of workers pushes it to storage and the callbacks persist the result.
+    """
+
+    def __init__(self, storage: MediaStorage, workers: int = UPLOAD_WORKERS, queue_depth: int = UPLOAD_QUEUE_DEPTH,
+                 max_per_owner: int = UPLOAD_MAX_PER_USER):
+        self.storage = storage
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.max_per_owner = max_per_owner
+        self._by_owner: Dict[object, int] = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+        self._pending = 0
+        upload_pending.set_function(lambda: self._pending)
+        self.media = MediaStore(storage, SessionLocal, self.run)
+
+    async def run(self, fn, *args):
+        """Run a blocking storage call on the upload threads"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def spool(self, upload: UploadFile, owner=None) -> SpooledUpload:
+        """
+        Reserves a slot and streams the request file to a temp file in chunks, hashing it as it goes.
+        The returned path must be handed to submit() or discard(). owner (the user id) gets at most
+        max_per_owner slots.
+        """
+        if self._pending >= self.workers + self.queue_depth:
+            upload_rejected.inc(reason="queue_full")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many uploads in progress, try again shortly",
+                headers={"Retry-After": "1"}
+            )
+        if owner is not None and self._by_owner.get(owner, 0) >= self.max_per_owner:
+            upload_rejected.inc(reason="user_limit")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail=f"At most {self.max_per_owner} uploads at a time, try again once one finished",
+                headers={"Retry-After": "1"}
+            )
+        self._reserve(owner)
+        suffix = os.path.splitext(upload.filename or "")[1]
+        started_at = perf_counter()
+        try:
+            with tempfile.NamedTemporaryFile(prefix=SPOOL_PREFIX, suffix=suffix, dir=UPLOAD_SPOOL_DIR, delete=False) as spooled:
+                sha256, size = await asyncio.to_thread(copy_hashed, upload.file, spooled)
+        except Exception:
+            self._release(owner)
+            raise
+        upload_spool_duration.observe(perf_counter() - started_at)
+        return SpooledUpload(spooled.name, sha256, size, owner)
+
+    def discard(self, path: str):
+        self._release(getattr(path, "owner", None))
+        self._remove(path)
+
+    def _reserve(self, owner):
+        self._pending += 1
+        if owner is not None:
+            self._by_owner[owner] = self._by_owner.get(owner, 0) + 1
+
+    def _release(self, owner):
+        self._pending -= 1
+        if owner is not None:
+            remaining = self._by_owner.pop(owner, 0) - 1
+            if remaining > 0:
+                self._by_owner[owner] = remaining
+
+    def submit(self, path: str, folder: str,
+               on_uploaded: Callable[[dict], Awaitable[None]],
+               on_failed: Optional[Callable[[Exception], Awaitable[None]]] = None):
+        if self._queue is None:
+            self._start()
+        self._queue.put_nowait((path, folder, on_uploaded, on_failed, perf_counter()))
+
+    def _start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        while True:
+            path, folder, on_uploaded, on_failed, queued_at = await self._queue.get()
+            started_at = perf_counter()
+            upload_queue_wait.observe(started_at - queued_at)
+            result = None
+            try:
+                # Known content takes a reference on the stored file instead of uploading again
+                result = await self.media.store(path, folder)
+                upload_duration.observe(perf_counter() - started_at, folder=folder)
+                await on_uploaded(result)
+            except Exception as exp:
+                if result is not None:
+                    # Stored but not persisted, nothing will ever release the reference otherwise
+                    try:
+                        await self.media.release(result["public_id"])
+                    except Exception:
+                        log.exception("releasing an unpersisted upload failed", folder=folder)
+                await self._fail(folder, on_failed, exp)
+            except asyncio.CancelledError:
+                await self._fail(folder, on_failed, RuntimeError("Server shut down during the upload"))
+                raise
+            finally:
+                self._release(getattr(path, "owner", None))
+                self._remove(path)
+                self._queue.task_done()
+
+    async def _fail(self, folder: str, on_failed, exp: Exception):
+        upload_failures.inc(folder=folder)
+        log.warning("upload failed", folder=folder, error=str(exp))
+        if on_failed is not None:
+            try:
+                await on_failed(exp)
+            except Exception:
+                log.exception("upload failure handler raised", folder=folder)
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clean_spool(self, stale_after: float = UPLOAD_STALE_AFTER):
+        """
+        Removes spool files a crashed process left behind. Only old ones: other processes may share
+        the directory and be spooling right now.
+        """
+        directory = UPLOAD_SPOOL_DIR or tempfile.gettempdir()
+        cutoff = time.time() - stale_after
+        removed = 0
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.startswith(SPOOL_PREFIX) and entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            log.info("stale spool files removed", removed=removed, directory=directory)
+        return removed
+
+    async def shutdown(self, grace: float = UPLOAD_SHUTDOWN_GRACE):
+        """
+        Gives queued uploads up to grace seconds to finish. Whatever is left fails through its
+        on_failed callback, so no message stays pending, and its spool file is removed.
+        """
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), grace)
+            except asyncio.TimeoutError:
+                log.warning("uploads unfinished at shutdown", pending=self._pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        while self._queue is not None and not self._queue.empty():
+            path, folder, on_uploaded, on_failed, queued_at = self._queue.get_nowait()
+            await self._fail(folder, on_failed, RuntimeError("Server shut down before the upload ran"))
+            self._release(getattr(path, "owner", None))
+            self._remove(path)
+        self._tasks = []
+        self._queue = None
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+upload_pipeline = UploadPipeline(storage)
@@ -0,0 +1,122 @@
+"""
+Content-addressed media. Every stored file is one media_asset row keyed by the SHA-256 of its bytes,
+computed while the upload is spooled. An upload whose hash is already known takes a reference on
+the existing public_id and thumbnail instead of going to storage again; the file is only deleted
+when release() drops the last reference.
+
+Files uploaded before this table existed have no row, release() deletes them directly as before.
+"""
+from typing import Awaitable, Callable, Optional
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from cloudinary_srv import MediaStorage, delete_file
+from database import Base, upsert_insert, utcnow
+from logs import get_logger
+from metrics import Counter
+
+
+class MediaAsset(Base):
+    __tablename__ = "media_asset"
+
+    sha256 = Column(String(64), primary_key=True)
+    public_id = Column(String, nullable=False, unique=True)
+    secure_url = Column(String, nullable=False)
+    thumbnail_url = Column(String, nullable=True)
+    thumbnail_id = Column(String, nullable=True)  # None when the thumbnail is derived or the original
+    size = Column(BigInteger, nullable=False, default=0)
+    ref_count = Column(Integer, nullable=False, default=1)
+    created_at = Column(DateTime, default=utcnow)
+
+
+log = get_logger("media_store")
+dedup_hits = Counter("media_dedup_hits_total", "Uploads served by an already stored file")
+dedup_bytes = Counter("media_dedup_bytes_total", "Upload bytes not sent to storage thanks to deduplication")
+assets_deleted = Counter("media_assets_deleted_total", "Stored files deleted after their last reference went away")
+
+_RESULT_COLUMNS = (MediaAsset.secure_url, MediaAsset.public_id, MediaAsset.thumbnail_url, MediaAsset.thumbnail_id)
+
+
+def asset_result(row, sha256: str) -> dict:
+    """Upload result in the storage's key names, plus thumbnail and hash"""
+    return {"secure_url": row.secure_url, "public_id": row.public_id, "thumbnail_url": row.thumbnail_url,
+            "thumbnail_id": row.thumbnail_id, "sha256": sha256}
+
+
+class MediaStore:
+
+    def __init__(self, storage: MediaStorage, session_factory: Callable[[], AsyncSession],
+                 run: Callable[..., Awaitable]):
+        self.storage = storage
+        self.session_factory = session_factory
+        # Blocking storage calls go through the upload pipeline's threads
+        self.run = run
+
+    async def store(self, path: str, folder: str) -> dict:
+        """Uploads a spooled file unless its content is already stored, either way holding one reference"""
+        sha256: Optional[str] = getattr(path, "sha256", None)
+        if sha256:
+            existing = await self._reference(sha256)
+            if existing is not None:
+                dedup_hits.inc(folder=folder)
+                dedup_bytes.inc(getattr(path, "size", 0), folder=folder)
+                return existing
+
+        result = await self.run(self.storage.upload, path, folder)
+        result = {**result, **await self.run(self.storage.thumbnail, path, result, folder)}
+        if not sha256:
+            return result
+        asset = await self._register(sha256, getattr(path, "size", 0), result)
+        if asset["public_id"] != result["public_id"]:
+            # An identical upload registered first, ours is a duplicate
+            await self._delete_files(result["public_id"], result.get("thumbnail_id"))
+        return asset
+
+    async def release(self, public_id: str):
+        """Drops one reference, the files go once nothing refers to them"""
+        async with self.session_factory() as db:
+            remaining = await db.scalar(
+                update(MediaAsset).where(MediaAsset.public_id == public_id)
+                .values(ref_count=MediaAsset.ref_count - 1).returning(MediaAsset.ref_count)
+            )
+            deleted = None
+            if remaining is not None and remaining <= 0:
+                # Guarded, a store() may have taken a new reference in between
+                deleted = (await db.execute(
+                    delete(MediaAsset).where(MediaAsset.public_id == public_id, MediaAsset.ref_count <= 0)
+                    .returning(MediaAsset.thumbnail_id)
+                )).first()
+            await db.commit()
+        if remaining is None:
+            await self._delete_files(public_id, None)
+        elif deleted is not None:
+            await self._delete_files(public_id, deleted.thumbnail_id)
+
+    async def _reference(self, sha256: str) -> Optional[dict]:
+        async with self.session_factory() as db:
+            row = (await db.execute(
+                update(MediaAsset).where(MediaAsset.sha256 == sha256)
+                .values(ref_count=MediaAsset.ref_count + 1).returning(*_RESULT_COLUMNS)
+            )).first()
+            await db.commit()
+        return asset_result(row, sha256) if row else None
+
+    async def _register(self, sha256: str, size: int, result: dict) -> dict:
+        async with self.session_factory() as db:
+            stmt = upsert_insert(db)(MediaAsset).values(
+                sha256=sha256, public_id=result["public_id"], secure_url=result["secure_url"],
+                thumbnail_url=result.get("thumbnail_url"), thumbnail_id=result.get("thumbnail_id"),
+                size=size, ref_count=1
+            )
+            stmt = stmt.on_conflict_do_update(index_elements=[MediaAsset.sha256],
+                                              set_={"ref_count": MediaAsset.ref_count + 1})
+            row = (await db.execute(stmt.returning(*_RESULT_COLUMNS))).first()
+            await db.commit()
+        return asset_result(row, sha256)
+
+    async def _delete_files(self, public_id: str, thumbnail_id: Optional[str]):
+        assets_deleted.inc()
+        for file_id in filter(None, (public_id, thumbnail_id)):
+            try:
+                await self.run(delete_file, file_id)
+            except Exception as exp:
+                log.warning("media delete failed", public_id=file_id, error=str(exp))
@@ -0,0 +1,150 @@
+import asyncio
+import os
+from collections import defaultdict
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+from sqlalchemy import select
+from database import SessionLocal
+from conversation.models import ConversationSummary
+from metrics import Counter
+from dotenv import load_dotenv
+load_dotenv()
+
+PRESENCE_BATCH_MS = int(os.getenv("PRESENCE_BATCH_MS", "250"))
+# all: every client sees every user, contacts: only users they have exchanged messages with
+PRESENCE_SCOPE = os.getenv("PRESENCE_SCOPE", "all")
+# Seconds a loaded contact set is trusted. New conversations extend it through add_contact, this
+# bounds how long one started through another process goes unnoticed
+PRESENCE_CONTACTS_TTL = float(os.getenv("PRESENCE_CONTACTS_TTL", "300"))
+
+presence_emits = Counter("presence_emits_total", "Presence events emitted")
+
+
+async def load_contact_ids(user_id: str) -> Set[str]:
+    """Users that have exchanged at least one message with user_id"""
+    try:
+        uid = int(user_id)
+    except ValueError:
+        return set()
+    async with SessionLocal() as db:
+        result = await db.execute(select(ConversationSummary.peer_id).where(ConversationSummary.user_id == uid))
+        return {str(row[0]) for row in result}
+
+
+class PresenceBroadcaster:
+    """
+    A connecting socket gets one getOnlineUsers snapshot, after that clients only receive
+    userOnline/userOffline deltas. Transitions are collected for `window` seconds and sent as
+    one list per event, a user flapping offline and back inside the window is never announced.
+    """
+
+    def __init__(self, sio, registry, window: float = PRESENCE_BATCH_MS / 1000, scope: str = PRESENCE_SCOPE,
+                 contacts_loader: Callable[[str], Awaitable[Set[str]]] = load_contact_ids,
+                 room_for: Callable[[str], str] = lambda user_id: f"user:{user_id}",
+                 contacts_ttl: float = PRESENCE_CONTACTS_TTL):
+        if scope not in ("all", "contacts"):
+            raise ValueError(f"Unknown PRESENCE_SCOPE {scope}")
+        self.sio = sio
+        self.registry = registry
+        self.window = window
+        self.scope = scope
+        self.contacts_loader = contacts_loader
+        self.room_for = room_for
+        self.contacts_ttl = contacts_ttl
+        self._online: Set[str] = set()
+        self._offline: Set[str] = set()
+        # user id: (loaded at, contact ids)
+        self._contacts: Dict[str, Tuple[float, Set[str]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _emit(self, event, user_ids, room=None):
+        presence_emits.inc(event=event)
+        # Strings, as JSON clients have always received them. MessagePack sends them as integers, see wire.py
+        await self.sio.emit(event, [str(user_id) for user_id in user_ids], room=room)
+
+    async def contacts(self, user_id: str) -> Set[str]:
+        cached = self._contacts.get(user_id)
+        if cached is None or monotonic() - cached[0] > self.contacts_ttl:
+            cached = self._contacts[user_id] = (monotonic(), await self.contacts_loader(user_id))
+        return cached[1]
+
+    async def add_contact(self, user_id, peer_id):
+        """
+        A message between two users makes them contacts. Loaded contact sets are extended, and when
+        both are online each is told the other is, instead of waiting for their next reconnect.
+        """
+        if self.scope != "contacts":
+            return
+        user_id, peer_id = str(user_id), str(peer_id)
+        for user, peer in ((user_id, peer_id), (peer_id, user_id)):
+            cached = self._contacts.get(user)
+            if cached is None or peer in cached[1]:
+                continue
+            cached[1].add(peer)
+            if self.registry.is_online(user) and self.registry.is_online(peer):
+                await self._emit("userOnline", [peer], room=self.room_for(user))
+
+    async def snapshot(self, sid: str, user_id: Optional[str]):
+        if self.scope == "contacts":
+            contacts = await self.contacts(user_id) if user_id else set()
+            online = [uid for uid in contacts if self.registry.is_online(uid)]
+            if user_id:
+                online.append(user_id)
+        else:
+            online = self.registry.online_users()
+        await self._emit("getOnlineUsers", online, room=sid)
+
+    def user_online(self, user_id: str):
+        if user_id in self._offline:
+            self._offline.discard(user_id)
+        else:
+            self._online.add(user_id)
+        self._schedule()
+
+    def user_offline(self, user_id: str):
+        if user_id in self._online:
+            self._online.discard(user_id)
+        else:
+            self._offline.add(user_id)
+        self._schedule()
+
+    def _schedule(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        online, offline = self._online, self._offline
+        self._online, self._offline = set(), set()
+
+        if self.scope == "all":
+            if online:
+                await self._emit("userOnline", sorted(online))
+            if offline:
+                await self._emit("userOffline", sorted(offline))
+        else:
+            # Group by recipient so each contact gets at most one event per kind
+            deltas = defaultdict(lambda: ([], []))
+            for index, changed in enumerate((online, offline)):
+                for user_id in changed:
+                    for contact in await self.contacts(user_id):
+                        if self.registry.is_online(contact):
+                            deltas[contact][index].append(user_id)
+            for contact, (came_online, went_offline) in deltas.items():
+                if came_online:
+                    await self._emit("userOnline", came_online, room=self.room_for(contact))
+                if went_offline:
+                    await self._emit("userOffline", went_offline, room=self.room_for(contact))
+
+        for user_id in offline:
+            if not self.registry.is_online(user_id):
+                self._contacts.pop(user_id, None)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
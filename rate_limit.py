@@ -0,0 +1,151 @@
+"""
+In-process token buckets for the endpoints and socket events a looping client can use to flood the
+database, the upload path or the presence broadcast.
+
+Every limited action has a bucket per user and one per client IP. A spec "<requests>/<seconds>"
+allows a burst of `requests` and refills at requests/seconds per second; an action takes a token
+from both buckets or is refused with the seconds until it would get one, and then takes from
+neither. Specs come from RATE_LIMIT_<NAME> and RATE_LIMIT_<NAME>_IP, "off" turns one off.
+
+State is per process, with several processes a client gets up to that many times the limit. The IP
+is the peer address of the connection. Behind a proxy that is the proxy's, set
+RATE_LIMIT_TRUST_FORWARDED_FOR so the first X-Forwarded-For entry is used instead.
+"""
+import math
+import os
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional, Tuple
+from fastapi import HTTPException, Request
+from starlette import status
+from metrics import Counter, Gauge
+from dotenv import load_dotenv
+load_dotenv()
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() not in ("0", "false", "no")
+RATE_LIMIT_TRUST_FORWARDED_FOR = os.getenv("RATE_LIMIT_TRUST_FORWARDED_FOR", "false").lower() in ("1", "true", "yes")
+# Buckets kept per limit and key kind, the least recently used one goes first (and comes back full)
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+# name: (per user, per IP), the IP limit leaves room for several users behind one address
+DEFAULT_LIMITS = {
+    "send_message": ("30/10", "300/10"),
+    "send_group_message": ("30/10", "300/10"),
+    "update_profile": ("5/60", "50/60"),
+    "socket_connect": ("10/60", "100/60"),
+    "socket_send_message": ("30/10", "300/10"),
+    "socket_send_group_message": ("30/10", "300/10"),
+}
+
+decisions = Counter("rate_limit_decisions_total", "Rate limited actions by limit, key kind and result")
+tracked_keys = Gauge("rate_limit_tracked_keys", "Token buckets held per limit and key kind")
+
+
+def parse_spec(spec: str) -> Optional[Tuple[float, float]]:
+    """(burst, refill per second) of a "<requests>/<seconds>" spec, None when it is off"""
+    if spec.strip().lower() in ("", "off", "0"):
+        return None
+    requests, seconds = spec.split("/", 1)
+    return float(requests), float(requests) / float(seconds)
+
+
+class TokenBucketLimiter:
+
+    def __init__(self, name: str, kind: str, spec: str, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.name = name
+        self.kind = kind
+        self.burst, self.refill = parse_spec(spec)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def _refilled(self, key, now: float) -> float:
+        tokens, updated = self._buckets.pop(key, (self.burst, now))
+        return min(self.burst, tokens + (now - updated) * self.refill)
+
+    def _store(self, key, tokens: float, now: float):
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        tracked_keys.set(len(self._buckets), limit=self.name, key=self.kind)
+
+    def check(self, key) -> float:
+        """0 when key has a token, otherwise the seconds until it has one. Takes nothing"""
+        now = monotonic()
+        tokens = self._refilled(key, now)
+        self._store(key, tokens, now)
+        if tokens >= 1:
+            return 0.0
+        decisions.inc(limit=self.name, key=self.kind, result="limited")
+        return (1 - tokens) / self.refill
+
+    def acquire(self, key) -> float:
+        """Takes a token for key, returns 0 or the seconds until one is available"""
+        wait = self.check(key)
+        if not wait:
+            now = monotonic()
+            self._store(key, self._refilled(key, now) - 1, now)
+            decisions.inc(limit=self.name, key=self.kind, result="allowed")
+        return wait
+
+
+class RateLimit:
+    """The per-user and per-IP bucket of one action"""
+
+    def __init__(self, name: str, per_user: str, per_ip: str):
+        self.name = name
+        per_user = os.getenv(f"RATE_LIMIT_{name.upper()}", per_user)
+        per_ip = os.getenv(f"RATE_LIMIT_{name.upper()}_IP", per_ip)
+        self.by_user = TokenBucketLimiter(name, "user", per_user) if parse_spec(per_user) else None
+        self.by_ip = TokenBucketLimiter(name, "ip", per_ip) if parse_spec(per_ip) else None
+
+    def acquire(self, user_id=None, ip: Optional[str] = None) -> float:
+        """0 when the action may go ahead, otherwise the seconds to wait. Unknown keys are not limited"""
+        if not RATE_LIMIT_ENABLED:
+            return 0.0
+        buckets = []
+        if self.by_ip is not None and ip:
+            buckets.append((self.by_ip, ip))
+        if self.by_user is not None and user_id is not None:
+            buckets.append((self.by_user, str(user_id)))
+        # Tokens are only taken once both allow, a refused attempt does not charge the other bucket
+        for limiter, key in buckets:
+            wait = limiter.check(key)
+            if wait:
+                return wait
+        for limiter, key in buckets:
+            limiter.acquire(key)
+        return 0.0
+
+
+limits = {name: RateLimit(name, per_user, per_ip) for name, (per_user, per_ip) in DEFAULT_LIMITS.items()}
+
+
+def retry_after(wait: float) -> int:
+    return max(1, math.ceil(wait))
+
+
+def forwarded_ip(forwarded_for: Optional[str]) -> Optional[str]:
+    if not RATE_LIMIT_TRUST_FORWARDED_FOR or not forwarded_for:
+        return None
+    return forwarded_for.split(",", 1)[0].strip() or None
+
+
+def request_ip(request: Request) -> Optional[str]:
+    return forwarded_ip(request.headers.get("x-forwarded-for")) or (request.client.host if request.client else None)
+
+
+def environ_ip(environ) -> Optional[str]:
+    """Client IP of a Socket.IO handshake, the ASGI environ's REMOTE_ADDR is a placeholder"""
+    client = environ.get("asgi.scope", {}).get("client")
+    return forwarded_ip(environ.get("HTTP_X_FORWARDED_FOR")) or (client[0] if client else environ.get("REMOTE_ADDR"))
+
+
+def enforce(name: str, request: Request, user_id=None):
+    """Raises 429 with Retry-After when the request is over the limit"""
+    wait = limits[name].acquire(user_id, request_ip(request))
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, slow down",
+            headers={"Retry-After": str(retry_after(wait))}
+        )
@@ -0,0 +1,268 @@
+import asyncio
+import os
+import pickle
+import stat
+import struct
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from dotenv import load_dotenv
+load_dotenv()
+
+# memory: single process, unix: several processes on one host sharing SOCKETIO_UNIX_DIR
+SOCKETIO_MANAGER = os.getenv("SOCKETIO_MANAGER", "memory")
+SOCKETIO_UNIX_DIR = os.getenv("SOCKETIO_UNIX_DIR", "/tmp/chat_socketio")
+
+_frame_header = struct.Struct("!I")
+
+
+class SocketRegistry:
+    """Which sockets each user has open, for this process only"""
+
+    def __init__(self):
+        self.user_sockets: Dict[str, Set[str]] = {}
+        self.socket_user_map: Dict[str, str] = {}
+        # Called with users that went offline without a disconnect on this process, see drop_host
+        self.on_offline: Optional[Callable[[str], None]] = None
+
+    def _add(self, user_id: str, sid: str, host_id: Optional[str] = None) -> bool:
+        """Returns True when this is the user's first live socket"""
+        self.socket_user_map[sid] = user_id
+        sockets = self.user_sockets.setdefault(user_id, set())
+        sockets.add(sid)
+        return len(sockets) == 1
+
+    def _remove(self, sid: str) -> Tuple[Optional[str], bool]:
+        """Returns the socket's user and whether that was the user's last live socket"""
+        user_id = self.socket_user_map.pop(sid, None)
+        if user_id is None:
+            return None, False
+        sockets = self.user_sockets.get(user_id)
+        if sockets is not None:
+            sockets.discard(sid)
+            if not sockets:
+                del self.user_sockets[user_id]
+                return user_id, True
+        return user_id, False
+
+    async def add(self, user_id: str, sid: str) -> bool:
+        return self._add(user_id, sid)
+
+    async def remove(self, sid: str) -> Tuple[Optional[str], bool]:
+        return self._remove(sid)
+
+    def is_online(self, user_id) -> bool:
+        return str(user_id) in self.user_sockets
+
+    def socket_count(self, user_id) -> int:
+        return len(self.user_sockets.get(str(user_id), ()))
+
+    def online_users(self):
+        return list(self.user_sockets.keys())
+
+    async def close(self):
+        pass
+
+
+class SharedSocketRegistry(SocketRegistry):
+    """
+    Registry mirrored across processes: local changes are published on the client manager's
+    channel and every node applies the changes of the others, so lookups stay local.
+    """
+
+    def __init__(self, manager: "UnixSocketManager"):
+        super().__init__()
+        self.manager = manager
+        self.socket_host_map: Dict[str, str] = {}
+        manager.registry = self
+
+    def _add(self, user_id: str, sid: str, host_id: Optional[str] = None) -> bool:
+        self.socket_host_map[sid] = host_id or self.manager.host_id
+        return super()._add(user_id, sid)
+
+    def _remove(self, sid: str) -> Tuple[Optional[str], bool]:
+        self.socket_host_map.pop(sid, None)
+        return super()._remove(sid)
+
+    async def add(self, user_id: str, sid: str) -> bool:
+        came_online = self._add(user_id, sid)
+        await self.manager.publish_presence("add", user_id=user_id, sid=sid)
+        return came_online
+
+    async def remove(self, sid: str) -> Tuple[Optional[str], bool]:
+        result = self._remove(sid)
+        await self.manager.publish_presence("remove", sid=sid)
+        return result
+
+    def drop_host(self, host_id: str) -> Set[str]:
+        """Forgets every socket of a host, returns the users left without one"""
+        gone = set()
+        for sid in [sid for sid, host in self.socket_host_map.items() if host == host_id]:
+            user_id, went_offline = self._remove(sid)
+            if went_offline:
+                gone.add(user_id)
+        return gone
+
+    def announce_offline(self, user_ids: Iterable[str]):
+        """
+        The host that held these users is gone and will not announce them. Every process that notices
+        does, clients treat a repeated userOffline as a no-op.
+        """
+        if self.on_offline is None:
+            return
+        for user_id in user_ids:
+            if not self.is_online(user_id):
+                self.on_offline(user_id)
+
+    def local_entries(self):
+        return [(user_id, sid) for sid, user_id in self.socket_user_map.items()
+                if self.socket_host_map.get(sid) == self.manager.host_id]
+
+    async def apply(self, message: dict):
+        op = message.get("op")
+        host_id = message["host_id"]
+        if op == "add":
+            self._add(message["user_id"], message["sid"], host_id)
+        elif op == "remove":
+            self._remove(message["sid"])
+        elif op == "snapshot":
+            gone = self.drop_host(host_id)
+            for user_id, sid in message["entries"]:
+                self._add(user_id, sid, host_id)
+            # Only users missing from the snapshot, the others were re-added
+            self.announce_offline(gone)
+        elif op == "sync_request":
+            await self.manager.publish_presence("snapshot", entries=self.local_entries())
+        elif op == "host_down":
+            self.announce_offline(self.drop_host(host_id))
+
+    async def close(self):
+        await self.manager.publish_presence("host_down")
+
+
+def check_private_directory(directory: str):
+    """Refuses a directory other users could plant sockets in, anything arriving there is unpickled"""
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError(f"SOCKETIO_UNIX_DIR {directory} is not a directory")
+    if info.st_uid != os.getuid():
+        raise RuntimeError(f"SOCKETIO_UNIX_DIR {directory} is owned by uid {info.st_uid}, not by this user")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        raise RuntimeError(f"SOCKETIO_UNIX_DIR {directory} has mode {stat.S_IMODE(info.st_mode):o}, it must be 700")
+
+
+class UnixSocketManager(AsyncPubSubManager):
+    """
+    Pub/sub client manager for several server processes on one machine. Every process listens on
+    <SOCKETIO_UNIX_DIR>/<host_id>.sock and publishes by writing length-prefixed pickles to its peers.
+    Peers are trusted with unpickling, so only processes able to write into the directory may join:
+    start() creates it private to the user and refuses to run in one that is not.
+    """
+    name = "unixsocket"
+
+    def __init__(self, directory: str = SOCKETIO_UNIX_DIR, channel="socketio", write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.directory = directory
+        self.path = os.path.join(directory, f"{self.host_id}.sock")
+        self.registry: Optional[SharedSocketRegistry] = None
+        self._inbox: Optional[asyncio.Queue] = None
+        self._server = None
+        self._peers: Dict[str, asyncio.StreamWriter] = {}
+        self._peer_locks: Dict[str, asyncio.Lock] = {}
+
+    async def publish_presence(self, op: str, **data):
+        await self._publish({"method": "presence", "op": op, "host_id": self.host_id, **data})
+
+    async def _publish(self, data):
+        frame = pickle.dumps(data)
+        frame = _frame_header.pack(len(frame)) + frame
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        peers = [name[:-5] for name in names if name.endswith(".sock") and name[:-5] != self.host_id]
+        await asyncio.gather(*(self._send(peer, frame) for peer in peers))
+
+    async def _send(self, peer: str, frame: bytes):
+        try:
+            writer = await self._connect(peer)
+            writer.write(frame)
+            await writer.drain()
+        except (ConnectionError, FileNotFoundError):
+            # Peer exited without cleaning up, forget its socket file and its clients
+            self._peers.pop(peer, None)
+            try:
+                os.remove(os.path.join(self.directory, f"{peer}.sock"))
+            except FileNotFoundError:
+                pass
+            if self.registry is not None:
+                self.registry.announce_offline(self.registry.drop_host(peer))
+
+    async def _connect(self, peer: str) -> asyncio.StreamWriter:
+        writer = self._peers.get(peer)
+        if writer is not None and not writer.is_closing():
+            return writer
+        lock = self._peer_locks.setdefault(peer, asyncio.Lock())
+        async with lock:
+            writer = self._peers.get(peer)
+            if writer is None or writer.is_closing():
+                _, writer = await asyncio.open_unix_connection(os.path.join(self.directory, f"{peer}.sock"))
+                self._peers[peer] = writer
+        return writer
+
+    async def _handle_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                header = await reader.readexactly(_frame_header.size)
+                (length,) = _frame_header.unpack(header)
+                self._inbox.put_nowait(pickle.loads(await reader.readexactly(length)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self):
+        if self._server is not None:
+            return
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        check_private_directory(self.directory)
+        self._inbox = asyncio.Queue()
+        self._server = await asyncio.start_unix_server(self._handle_peer, path=self.path)
+        if self.registry is not None:
+            await self.publish_presence("sync_request")
+
+    async def _listen(self):
+        await self.start()
+        while True:
+            message = await self._inbox.get()
+            if message.get("method") == "presence":
+                if self.registry is not None:
+                    await self.registry.apply(message)
+                continue
+            yield message
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        for writer in self._peers.values():
+            writer.close()
+        self._peers = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def create_client_manager():
+    if SOCKETIO_MANAGER == "memory":
+        return socketio.AsyncManager()
+    if SOCKETIO_MANAGER == "unix":
+        return UnixSocketManager()
+    raise ValueError(f"Unknown SOCKETIO_MANAGER {SOCKETIO_MANAGER}")
+
+
+def create_registry(manager) -> SocketRegistry:
+    if isinstance(manager, UnixSocketManager):
+        return SharedSocketRegistry(manager)
+    return SocketRegistry()
@@ -0,0 +1,155 @@
+"""
+Per-connection wire format for Socket.IO.
+
+Clients keep the default JSON text packets unless they connect with `?wire=msgpack` and a
+MessagePack parser (socket.io-msgpack-parser, or serializer="msgpack" in python-socketio). For
+those sockets packets are MessagePack maps and event payloads are compacted on the way out:
+user ids in presence events, strings for JSON clients, become integers and ISO `*_at` timestamps
+become epoch milliseconds. Incoming packets are decoded by type, text as JSON and bytes as
+MessagePack.
+
+A broadcast is still encoded once per format, not once per recipient.
+"""
+from datetime import datetime, timezone
+from typing import Dict
+import msgpack
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+from metrics import Counter
+
+WIRE_FORMATS = ("json", "msgpack")
+# Events whose payload is a list of user ids
+ID_LIST_EVENTS = {"getOnlineUsers", "userOnline", "userOffline"}
+
+wire_connections = Counter("socketio_connections_total", "Engine.IO connections by negotiated wire format")
+emits = Counter("socketio_emits_total", "Socket.IO emits by event, one per call whatever the number of recipients")
+packets_sent = Counter("socketio_packets_sent_total", "Packets written to sockets by wire format")
+
+
+def to_epoch_ms(value: str):
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if timestamp.tzinfo is None:
+        # Timestamps are stored as naive UTC
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+def compact(value):
+    """Copy of an event argument with ISO `*_at` values as epoch milliseconds"""
+    if isinstance(value, dict):
+        return {key: to_epoch_ms(item) if key.endswith("_at") and isinstance(item, str) else compact(item)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [compact(item) for item in value]
+    return value
+
+
+def to_int_ids(ids):
+    try:
+        return list(map(int, ids))
+    except (TypeError, ValueError):
+        return ids
+
+
+def compact_event(data):
+    event, args = data[0], data[1:]
+    if event in ID_LIST_EVENTS:
+        args = [to_int_ids(arg) if isinstance(arg, list) else arg for arg in args]
+    else:
+        args = [compact(arg) for arg in args]
+    return [event] + args
+
+
+class EncodedPacket(str):
+    """JSON text of a packet that can render the same packet as MessagePack once, on first demand"""
+
+    def __new__(cls, text: str, pkt: "WirePacket"):
+        encoded = super().__new__(cls, text)
+        encoded.packet = pkt
+        encoded._msgpack = None
+        return encoded
+
+    def msgpack_eio_packet(self):
+        if self._msgpack is None:
+            self._msgpack = eio_packet.Packet(eio_packet.MESSAGE, self.packet.encode_msgpack())
+        return self._msgpack
+
+
+class WirePacket(packet.Packet):
+
+    def encode(self):
+        encoded = super().encode()
+        # Binary attachments keep the plain JSON framing
+        return encoded if isinstance(encoded, list) else EncodedPacket(encoded, self)
+
+    def encode_msgpack(self) -> bytes:
+        data = self.data
+        if self.packet_type == packet.EVENT and data:
+            data = compact_event(data)
+        elif self.packet_type == packet.ACK and data:
+            data = compact(data)
+        encoded = {"type": self.packet_type, "data": data, "nsp": self.namespace}
+        if self.id:
+            encoded["id"] = self.id
+        return msgpack.dumps(encoded)
+
+    def decode(self, encoded_packet):
+        if not isinstance(encoded_packet, (bytes, bytearray)):
+            return super().decode(encoded_packet)
+        decoded = msgpack.loads(encoded_packet)
+        self.packet_type = decoded["type"]
+        self.data = decoded.get("data")
+        self.id = decoded.get("id")
+        self.namespace = decoded["nsp"]
+        return 0
+
+
+class NegotiatingServer(socketio.AsyncServer):
+    """AsyncServer that encodes every outgoing packet in the wire format its client asked for"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, serializer=WirePacket, **kwargs)
+        self.wire_formats: Dict[str, str] = {}
+
+    def wire_format(self, eio_sid) -> str:
+        return self.wire_formats.get(eio_sid, "json")
+
+    async def _handle_eio_connect(self, eio_sid, environ):
+        query = environ.get("QUERY_STRING", "")
+        params = dict(qc.split("=", 1) for qc in query.split("&") if "=" in qc)
+        wire = params.get("wire", "json")
+        if wire not in WIRE_FORMATS:
+            wire = "json"
+        if wire != "json":
+            self.wire_formats[eio_sid] = wire
+        wire_connections.inc(format=wire)
+        return await super()._handle_eio_connect(eio_sid, environ)
+
+    async def _handle_eio_disconnect(self, eio_sid):
+        try:
+            return await super()._handle_eio_disconnect(eio_sid)
+        finally:
+            self.wire_formats.pop(eio_sid, None)
+
+    async def emit(self, event, *args, **kwargs):
+        emits.inc(event=event)
+        return await super().emit(event, *args, **kwargs)
+
+    async def _send_packet(self, eio_sid, pkt):
+        packets_sent.inc(format=self.wire_format(eio_sid))
+        if self.wire_format(eio_sid) == "msgpack":
+            await self.eio.send(eio_sid, pkt.encode_msgpack())
+        else:
+            await super()._send_packet(eio_sid, pkt)
+
+    async def _send_eio_packet(self, eio_sid, eio_pkt):
+        # Broadcasts arrive here with the JSON text shared by all recipients
+        wire = self.wire_format(eio_sid)
+        packets_sent.inc(format=wire)
+        if wire == "msgpack" and isinstance(eio_pkt.data, EncodedPacket):
+            eio_pkt = eio_pkt.data.msgpack_eio_packet()
+        await super()._send_eio_packet(eio_sid, eio_pkt)